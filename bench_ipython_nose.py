@@ -0,0 +1,294 @@
+"""Measure what ipython_nose itself costs, without a notebook or browser.
+
+Builds synthetic kernel namespaces and test suites, then times:
+
+* turning a namespace into a test module: by copying all of it, as %nose
+  did before the DiscoveryCache, and through the DiscoveryCache, cold and
+  warm,
+* loading the tests from that module,
+* reporting each result through ConsoleLiveOutput, NotebookLiveOutput and
+  DisplayLiveOutput (with displaypub, and IPython's display functions,
+  replaced by stand-ins that only count what would be published),
+* rendering the results with _repr_html_.
+
+Each measurement is written as one line of JSON, so runs can be kept and
+compared::
+
+    $ python bench_ipython_nose.py --output before.jsonl
+    ... change things ...
+    $ python bench_ipython_nose.py --output after.jsonl --compare before.jsonl
+"""
+from __future__ import print_function
+
+import json
+import optparse
+import platform
+import sys
+import types
+
+from nose import loader as nose_loader
+from nose.config import Config
+from nose.selector import Selector
+
+import ipython_nose
+
+
+namespace_sizes = (1000, 10000, 100000)
+suite_sizes = (100, 1000, 10000)
+
+
+class CountingDisplayPub(object):
+    """Stands in for IPython.core.displaypub, counting what is published."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish_display_data(self, source, data, metadata=None):
+        self.messages += 1
+        self.bytes += sum(len(value) for value in data.values())
+
+
+class CountingDisplay(object):
+    """Stands in for IPython.display's display and update_display."""
+
+    def __init__(self, displaypub):
+        self.displaypub = displaypub
+
+    def __call__(self, data, raw=False, display_id=None):
+        self.displaypub.publish_display_data(None, data)
+
+
+class NullStream(object):
+    def write(self, text):
+        pass
+
+
+def make_test(number, fails):
+    if fails:
+        def test():
+            assert number < 0, 'synthetic failure %d' % number
+    else:
+        def test():
+            assert number >= 0
+    test.__name__ = 'test_%05d' % number
+    test.__module__ = '__main__'
+    return test
+
+
+class Helper(object):
+    pass
+
+
+def make_namespace(size, tests=0, failure_rate=0.0):
+    """A namespace like a well-used kernel's: ``size`` assorted objects, of
+    which ``tests`` are test functions, ``failure_rate`` of them failing.
+    """
+    namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+    failing_every = int(1 / failure_rate) if failure_rate else 0
+    for number in range(tests):
+        fails = failing_every and number % failing_every == 0
+        test = make_test(number, fails)
+        namespace[test.__name__] = test
+    kinds = (
+        lambda number: number,
+        lambda number: 'value %d' % number,
+        lambda number: list(range(number % 10)),
+        lambda number: make_test(number, False),
+        lambda number: type('Helper%d' % number, (Helper,), {}),
+        lambda number: types.ModuleType('module%d' % number),
+    )
+    for number in range(size - tests):
+        namespace['name_%d' % number] = kinds[number % len(kinds)](number)
+    return namespace
+
+
+def best_of(repeat, function):
+    """Return the shortest time ``function`` took over ``repeat`` calls,
+    and what it returned the last time.
+    """
+    best = None
+    for _ in range(repeat):
+        started = ipython_nose.timer()
+        result = function()
+        seconds = ipython_nose.timer() - started
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+
+def full_copy(namespace):
+    # What %nose did with the namespace before the DiscoveryCache
+    test_module = types.ModuleType('test_module')
+    test_module.__dict__.update(namespace)
+    return test_module
+
+
+def bench_namespaces(sizes, repeat):
+    config = Config()
+    selector = Selector(config)
+    for size in sizes:
+        namespace = make_namespace(size, tests=min(size // 10, 1000))
+
+        seconds, _ = best_of(repeat, lambda: full_copy(namespace))
+        yield {'name': 'namespace.full_copy', 'size': size,
+               'seconds': seconds}
+
+        seconds, _ = best_of(repeat, lambda: ipython_nose.DiscoveryCache()
+                             .test_module(namespace, selector))
+        yield {'name': 'namespace.discovery_cache.cold', 'size': size,
+               'seconds': seconds}
+
+        cache = ipython_nose.DiscoveryCache()
+        cache.test_module(namespace, selector)
+        seconds, _ = best_of(
+            repeat, lambda: cache.test_module(namespace, selector))
+        yield {'name': 'namespace.discovery_cache.warm', 'size': size,
+               'seconds': seconds}
+
+
+def load_suite(namespace):
+    loader = nose_loader.TestLoader(config=Config())
+    test_module = ipython_nose.DiscoveryCache().test_module(
+        namespace, Selector(loader.config))
+    return loader.loadTestsFromModule(test_module)
+
+
+def results(suite):
+    """Yield ``(test, exc_info)`` for each test in ``suite``, running it
+    outside nose; ``exc_info`` is None if it passed.
+    """
+    for test in suite:
+        try:
+            test.test.test()
+        except AssertionError:
+            yield test, sys.exc_info()
+        else:
+            yield test, None
+
+
+def report_results(plugin, outcomes):
+    for test, exc_info in outcomes:
+        plugin.startTest(test)
+        if exc_info is None:
+            plugin.addSuccess(test)
+        else:
+            plugin.addFailure(test, exc_info)
+        plugin.stopTest(test)
+    plugin.live_output.finalize()
+    return plugin
+
+
+def make_plugin(live_output):
+    plugin = ipython_nose.IPythonDisplay()
+    plugin.stream = NullStream()
+    if live_output == 'console':
+        plugin.live_output = ipython_nose.ConsoleLiveOutput(plugin)
+    elif live_output == 'notebook':
+        plugin.live_output = ipython_nose.NotebookLiveOutput()
+    elif live_output == 'display':
+        plugin.live_output = ipython_nose.DisplayLiveOutput()
+    else:
+        plugin.live_output = ipython_nose.NotebookLiveOutput(
+            flush_every=100)
+    return plugin
+
+
+def bench_suites(sizes, failure_rate, repeat):
+    displaypub = ipython_nose.displaypub
+    display = ipython_nose.display, ipython_nose.update_display
+    try:
+        for size in sizes:
+            namespace = make_namespace(size, size, failure_rate)
+            seconds, suite = best_of(repeat, lambda: load_suite(namespace))
+            yield {'name': 'discovery.load', 'size': size,
+                   'failure_rate': failure_rate, 'seconds': seconds}
+
+            outcomes = list(results(suite))
+            for live_output in (
+                    'console', 'notebook', 'notebook_batched', 'display'):
+                published = ipython_nose.displaypub = CountingDisplayPub()
+                ipython_nose.display = ipython_nose.update_display = \
+                    CountingDisplay(published)
+                seconds, plugin = best_of(repeat, lambda: report_results(
+                    make_plugin(live_output), outcomes))
+                yield {'name': 'live_output.' + live_output, 'size': size,
+                       'failure_rate': failure_rate, 'seconds': seconds,
+                       'per_result_us': seconds / size * 1e6,
+                       'messages': published.messages // repeat,
+                       'bytes': published.bytes // repeat}
+
+            seconds, html = best_of(repeat, plugin._repr_html_)
+            yield {'name': 'render.repr_html', 'size': size,
+                   'failure_rate': failure_rate, 'seconds': seconds,
+                   'bytes': len(html)}
+    finally:
+        ipython_nose.displaypub = displaypub
+        ipython_nose.display, ipython_nose.update_display = display
+
+
+def key(record):
+    return (record['name'], record['size'], record.get('failure_rate'))
+
+
+def compare(records, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = dict(
+            (key(record), record) for record in map(json.loads, baseline_file)
+            if 'name' in record)
+    for record in records:
+        before = baseline.get(key(record))
+        if before is None or not before['seconds']:
+            continue
+        print('%-32s %7d %10.6fs %10.6fs %6.2fx' % (
+            record['name'], record['size'], before['seconds'],
+            record['seconds'], record['seconds'] / before['seconds']))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '--output', metavar='PATH',
+        help='write the results to PATH instead of standard output')
+    parser.add_option(
+        '--compare', metavar='PATH',
+        help='print how the results compare to an earlier --output')
+    parser.add_option(
+        '--failure-rate', type='float', default=0.1,
+        help='share of the synthetic tests that fail [%default]')
+    parser.add_option(
+        '--repeat', type='int', default=3,
+        help='time each measurement this many times, keeping the best '
+             '[%default]')
+    parser.add_option(
+        '--quick', action='store_true',
+        help='only use the smallest namespace and suite')
+    options, args = parser.parse_args(argv)
+
+    namespaces = namespace_sizes[:1] if options.quick else namespace_sizes
+    suites = suite_sizes[:1] if options.quick else suite_sizes
+
+    records = []
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        output.write(json.dumps({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': options.repeat}, sort_keys=True) + '\n')
+        for benchmarks in (
+                bench_namespaces(namespaces, options.repeat),
+                bench_suites(suites, options.failure_rate, options.repeat)):
+            for record in benchmarks:
+                records.append(record)
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    if options.compare:
+        compare(records, options.compare)
+
+
+if __name__ == '__main__':
+    main()
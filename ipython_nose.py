@@ -1,20 +1,76 @@
 import cgi
+import collections
+import contextlib
+import cProfile
+import ctypes
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
 import os
+import pickle
+import pstats
 import traceback
 import re
 import shlex
+import signal
 import string
 import sys
+import threading
+import time
 import types
 import uuid
+import zlib
+from inspect import isfunction
+try:
+    from configparser import RawConfigParser
+except ImportError:
+    from ConfigParser import RawConfigParser
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    # New in Python 3.4
+    tracemalloc = None
 
 from nose import core as nose_core
 from nose import loader as nose_loader
+from nose.suite import ContextList
 from nose.config import Config, all_config_files
 from nose.plugins.base import Plugin
 from nose.plugins.skip import SkipTest
-from nose.plugins.manager import DefaultPluginManager
+from nose.selector import Selector
+from nose.plugins.manager import (
+    DefaultPluginManager, PluginManager, ZeroNinePlugin)
+from nose.util import isclass
 from IPython.core import displaypub, magic
+try:
+    from traitlets.config import Config as ShellConfig
+except ImportError:
+    # Before IPython 4.0
+    from IPython.config import Config as ShellConfig
+from IPython.core.error import UsageError
+try:
+    from IPython.display import display, update_display
+except ImportError:
+    # Displays that can be updated in place are newer
+    display = update_display = None
+from xml.sax.saxutils import escape as xml_escape, quoteattr
 
 
 class Template(string.Formatter):
@@ -27,6 +83,8 @@ class Template(string.Formatter):
     def convert_field(self, value, conversion):
         if conversion == 'e':
             return cgi.escape(value)
+        elif conversion == 'l':
+            return html_traceback(value)
         else:
             return super(Template, self).convert_field(value, conversion)
 
@@ -43,7 +101,20 @@ class DummyUnittestStream:
 
 
 class NotebookLiveOutput(object):
-    def __init__(self):
+    """Live progress for the notebook, appended to a div under the cell.
+
+    Progress is queued and published as a single javascript snippet once
+    ``flush_every`` results are pending or ``flush_interval`` seconds have
+    passed since the last publish, whichever comes first. ``None`` disables
+    either threshold; the defaults publish every result immediately.
+    """
+
+    def __init__(self, flush_every=1, flush_interval=None):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._pending_results = 0
+        self._last_flush = time.time()
         self.output_id = 'ipython_nose_%s' % uuid.uuid4().hex
         displaypub.publish_display_data(
          u'IPython.core.displaypub.publish_html',
@@ -54,46 +125,962 @@ class NotebookLiveOutput(object):
           'document.%s = $("#%s");' % (self.output_id, self.output_id)})
 
     def finalize(self):
+        self.flush()
         displaypub.publish_display_data(
          u'IPython.core.displaypub.publish_javascript',
          {'application/javascript':
           'delete document.%s;' % self.output_id})
 
-
-    def write_chars(self, chars):
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._pending:
+            return
+        html = ''.join(self._pending)
+        self._pending = []
+        self._pending_results = 0
         displaypub.publish_display_data(
          u'IPython.core.displaypub.publish_javascript',
          {'application/javascript':
-          'document.%s.append($("<span>%s</span>"));' % (
-                self.output_id, cgi.escape(chars))})
+          'document.%s.append(%s);' % (self.output_id, json.dumps(html))})
+
+    def _queue(self, html):
+        self._pending.append(html)
+        self._pending_results += 1
+        if self.flush_every is not None and \
+                self._pending_results >= self.flush_every:
+            self.flush()
+        elif self.flush_interval is not None and \
+                time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_chars(self, chars):
+        self._queue('<span>%s</span>' % cgi.escape(chars))
 
     def write_line(self, line):
-        displaypub.publish_display_data(
-         u'IPython.core.displaypub.publish_javascript',
-         {'application/javascript':
-          'document.%s.append($("<div>%s</div>"));' % (
-                self.output_id, cgi.escape(line))})
+        self._queue('<div>%s</div>' % cgi.escape(line))
+
+
+class LiveProgress(object):
+    """Counts the results written to a live output, for outputs that show
+    how the run is going rather than every result.
+    """
+
+    # What each of the characters the plugin writes stands for
+    _outcomes = {'.': 'passed', 'F': 'failed', 'E': 'errors', 'S': 'skipped'}
+    # ...and each of the words, in verbose runs
+    _words = {
+        'pass': 'passed', 'fail': 'failed', 'error': 'errors',
+        'SKIP': 'skipped'}
+
+    def __init__(self):
+        self.counts = dict((outcome, 0) for outcome in self._outcomes.values())
+        self._started = timer()
+
+    def _count_chars(self, chars):
+        for char in chars:
+            outcome = self._outcomes.get(char)
+            if outcome is not None:
+                self.counts[outcome] += 1
+
+    def _count_line(self, line):
+        outcome = self._words.get(line.rsplit(' ... ', 1)[-1])
+        if outcome is not None:
+            self.counts[outcome] += 1
+
+    def _progress_text(self):
+        tests = sum(self.counts.values())
+        seconds = timer() - self._started
+        return (
+            '%(passed)d passed, %(failed)d failed, %(errors)d errors, '
+            '%(skipped)d skipped' % self.counts
+            + ' (%.1f tests/s)' % (tests / seconds if seconds > 0 else 0.0))
+
+
+class DisplayLiveOutput(LiveProgress):
+    """Live progress for the notebook, kept in a single display under the
+    cell that is updated in place, at most every ``flush_interval`` seconds.
+
+    Every update is about the same size however many tests have run: the
+    counts so far and tests per second, then the last few lines of a
+    verbose run or the last results' ``.FES`` characters. Frontends don't
+    need to run any javascript for it.
+    """
+
+    flush_interval = 0.2
+    # Lines of a verbose run shown, and characters shown of each line or of
+    # the results' characters
+    tail_lines = 5
+    tail_width = 200
+
+    _template_html = Template(
+        '''<div class="noselive">{progress!e}<pre>{tail!e}</pre></div>''')
+
+    def __init__(self, flush_interval=None):
+        super(DisplayLiveOutput, self).__init__()
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        self._lines = collections.deque(maxlen=self.tail_lines)
+        self._chars = collections.deque(maxlen=self.tail_width)
+        self._last_flush = self._started
+        self.display_id = 'ipython_nose_%s' % uuid.uuid4().hex
+        display(self._data(), raw=True, display_id=self.display_id)
+
+    def _data(self):
+        progress = self._progress_text()
+        tail = '\n'.join(self._lines) if self._lines else ''.join(self._chars)
+        return {
+            'text/html': self._template_html.format(
+                progress=progress, tail=tail),
+            'text/plain': progress + '\n' + tail,
+        }
+
+    def finalize(self):
+        self.flush()
 
+    def flush(self):
+        self._last_flush = timer()
+        update_display(self._data(), raw=True, display_id=self.display_id)
 
+    def _queue(self):
+        if timer() - self._last_flush >= self.flush_interval:
+            self.flush()
 
-class ConsoleLiveOutput(object):
-    def __init__(self, stream_obj):
+    def write_chars(self, chars):
+        self._count_chars(chars)
+        self._chars.extend(chars)
+        self._queue()
+
+    def write_line(self, line):
+        self._count_line(line)
+        self._lines.append(line[:self.tail_width])
+        self._queue()
+
+
+class ConsoleLiveOutput(LiveProgress):
+    """Live progress for terminal IPython, written to ``stream_obj.stream``.
+
+    Progress is buffered and written at most every ``flush_interval``
+    seconds. On a terminal it is a single line, redrawn in place, counting
+    the results so far and tests per second; otherwise, e.g. when piped
+    into a CI log, the usual ``.FES`` characters are written in chunks.
+    """
+
+    flush_interval = 0.5
+
+    def __init__(self, stream_obj, flush_interval=None, tty=None):
+        super(ConsoleLiveOutput, self).__init__()
         self.stream_obj = stream_obj
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        self.tty = tty
+        self._pending = []
+        self._last_flush = self._started
+
+    @property
+    def stream(self):
+        return self.stream_obj.stream
+
+    def _is_tty(self):
+        if self.tty is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            try:
+                self.tty = bool(isatty and isatty())
+            except ValueError:
+                # Closed
+                self.tty = False
+        return self.tty
 
     def finalize(self):
-        self.stream_obj.stream.write('\n')
+        self.flush()
+        self.stream.write('\n')
+
+    def flush(self):
+        self._last_flush = timer()
+        if self._is_tty():
+            # Lines from verbose runs go above the progress line
+            lines = ''.join(self._pending)
+            self._pending = []
+            self.stream.write('\r\x1b[K' + lines + self._progress_text())
+        elif self._pending:
+            self.stream.write(''.join(self._pending))
+            self._pending = []
+        flush = getattr(self.stream, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def _queue(self, text):
+        if text is not None:
+            self._pending.append(text)
+        if timer() - self._last_flush >= self.flush_interval:
+            self.flush()
 
     def write_chars(self, chars):
-        self.stream_obj.stream.write(chars)
+        self._count_chars(chars)
+        self._queue(None if self._is_tty() else chars)
 
     def write_line(self, line):
-        self.stream_obj.stream.write(line + '\n')
+        self._count_line(line)
+        self._queue(line + '\n')
+
+
+# Highest resolution clock available
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def _split_test_id(test_id):
+    """Split a test id into JUnit's classname and name, ignoring any dots
+    in a generated test's arguments.
+    """
+    dot = test_id.split('(', 1)[0].rfind('.')
+    if dot < 0:
+        return '', test_id
+    return test_id[:dot], test_id[dot + 1:]
+
+
+class StreamingReport(object):
+    """A report file written a test at a time.
+
+    The report is written to ``path + '.partial'`` as the tests run, and
+    only replaces ``path`` once it is closed, so ``path`` never holds half
+    a report. After each result the partial file is rewritten from the end
+    of the last result onwards, so it is always a complete, valid report
+    too: a killed kernel leaves behind the results so far. Nothing is kept
+    in memory but the totals.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.file = open(self.partial_path, 'wb')
+        self.totals = {
+            'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0, 'time': 0.0}
+        self.file.write(_to_bytes(self._header()))
+        self._end = self.file.tell()
+        self._write_tail()
+
+    def add(self, test, outcome, seconds, failure=None):
+        self.totals['tests'] += 1
+        if outcome == 'fail':
+            self.totals['failures'] += 1
+        elif outcome == 'error':
+            self.totals['errors'] += 1
+        elif outcome == 'skip':
+            self.totals['skipped'] += 1
+        self.totals['time'] += seconds or 0.0
+        self.file.seek(self._end)
+        self.file.write(_to_bytes(
+            self._result(test, outcome, seconds or 0.0, failure)))
+        self._end = self.file.tell()
+        self._write_tail()
+
+    def _write_tail(self):
+        self.file.write(_to_bytes(self._footer()))
+        self.file.truncate()
+        self._update_header()
+        self.file.flush()
+
+    def _update_header(self):
+        pass
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        replace_file(self.partial_path, self.path)
+
+
+class JSONReport(StreamingReport):
+    def _header(self):
+        return '{"results": ['
+
+    def _result(self, test, outcome, seconds, failure):
+        result = {
+            'id': test.id(),
+            'name': test.shortDescription() or str(test),
+            'outcome': outcome,
+            'time': seconds,
+        }
+        if failure is not None:
+            result.update(
+                exc_type=failure.exc_type, message=failure.message,
+                traceback=failure.formatted_traceback)
+        separator = '\n' if self.totals['tests'] == 1 else ',\n'
+        return separator + json.dumps(result, sort_keys=True)
+
+    def _footer(self):
+        return '\n], "summary": %s}\n' % json.dumps(
+            self.totals, sort_keys=True)
+
+
+class JUnitReport(StreamingReport):
+    # The header is padded to this width so that the totals in it can be
+    # updated in place
+    header_width = 256
+
+    def _header(self):
+        header = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<testsuite name="ipython_nose" tests="%(tests)d"'
+            ' failures="%(failures)d" errors="%(errors)d"'
+            ' skipped="%(skipped)d" time="%(time).3f"' % self.totals)
+        return header.ljust(self.header_width - 2) + '>\n'
+
+    def _update_header(self):
+        self.file.seek(0)
+        self.file.write(_to_bytes(self._header()))
+        self.file.seek(0, os.SEEK_END)
+
+    def _result(self, test, outcome, seconds, failure):
+        classname, name = _split_test_id(test.id())
+        output = ['<testcase classname=%s name=%s time="%.3f"' % (
+            quoteattr(classname), quoteattr(name), seconds)]
+        if outcome == 'pass':
+            output.append('/>\n')
+        elif outcome == 'skip':
+            output.append('><skipped/></testcase>\n')
+        else:
+            tag = 'failure' if outcome == 'fail' else 'error'
+            output.append('><%s type=%s message=%s>%s</%s></testcase>\n' % (
+                tag, quoteattr(failure.exc_type), quoteattr(failure.message),
+                xml_escape(failure.formatted_traceback), tag))
+        return ''.join(output)
+
+    def _footer(self):
+        return '</testsuite>\n'
+
+
+# Not in Python 2, whose os.rename can't replace a file on Windows
+replace_file = getattr(os, 'replace', os.rename)
+
+
+def open_report(path):
+    """Start a streaming report, in a format chosen by ``path``'s
+    extension.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        return JSONReport(path)
+    elif extension == '.xml':
+        return JUnitReport(path)
+    raise UsageError('--report must name a .json or .xml file')
 
 
 def html_escape(s):
     return cgi.escape(str(s))
 
 
+# The name IPython gives a cell's code, e.g. <ipython-input-10-a3ae96abafeb>,
+# and, in an escaped traceback, the line number that follows it
+_input_name = re.compile(
+    r'ipython-input-(\d+)-[0-9a-f]{12}(?=(?:&gt;", line (\d+))?)')
+
+
+class CellSourceIndex(object):
+    """Finds the cells behind traceback frames, by the cell number in the
+    names IPython compiles cells under.
+
+    The sources come from the shell's input history, which has each cell as
+    compiled, after %magic and the like were turned into code, but with
+    trailing whitespace stripped, so they can't be matched to the hash in
+    the name.
+    """
+
+    def __init__(self, shell=None):
+        self.shell = shell
+
+    def lookup(self, name):
+        """Return ``(cell number, source)`` for the cell compiled as
+        ``name``, or None if it isn't one of this kernel's.
+        """
+        match = _input_name.search(name)
+        if self.shell is None or match is None:
+            return None
+        number = int(match.group(1))
+        sources = self.shell.history_manager.input_hist_parsed
+        if not 1 <= number < len(sources):
+            return None
+        return number, sources[number]
+
+    def line(self, name, number):
+        """Return line ``number`` (counting from 1) of the cell compiled as
+        ``name``, or None.
+        """
+        cell = self.lookup(name)
+        if cell is None:
+            return None
+        lines = cell[1].splitlines()
+        if 1 <= number <= len(lines):
+            return lines[number - 1].strip()
+        return None
+
+
+# The kernel's cells, once the extension is loaded
+_cell_index = CellSourceIndex()
+
+
+def html_traceback(text):
+    """Escape a formatted traceback for HTML, linking the frames from
+    notebook cells to their cells.
+
+    Only the ``File "..."`` lines name a frame, so only they are searched.
+    """
+    lines = cgi.escape(text).split('\n')
+    for index, line in enumerate(lines):
+        if line.startswith('  File "'):
+            lines[index] = _input_name.sub(IPythonDisplay.make_link, line)
+    return '\n'.join(lines)
+
+
+def clip(text, size):
+    """Shorten ``text`` to about ``size`` characters by cutting out its
+    middle, keeping the start and the end, which are usually the parts of a
+    traceback worth reading.
+    """
+    if len(text) <= size:
+        return text
+    marker = '\n[... %d characters cut ...]\n'
+    half = max(size - len(marker) - 10, 0) // 2
+    return (text[:half] + marker % (len(text) - 2 * half)
+            + text[len(text) - half:])
+
+
+class BoundedOutput(object):
+    """Gathers the pieces of a report, up to ``limit`` characters (None
+    or 0 for no limit), joining them only once at the end.
+
+    A piece that would go over the limit is left out, along with everything
+    after it, and ``truncated`` is set.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit or None
+        self.parts = []
+        self.size = 0
+        self.truncated = False
+
+    def room(self):
+        """Characters left before the limit, or None if there isn't one."""
+        if self.limit is None:
+            return None
+        return self.limit - self.size
+
+    def write(self, text):
+        """Add ``text``, returning whether it fitted."""
+        if self.truncated:
+            return False
+        if self.limit is not None and self.size + len(text) > self.limit:
+            self.truncated = True
+            return False
+        self.parts.append(text)
+        self.size += len(text)
+        return True
+
+    def write_marker(self, text):
+        """Add ``text`` whatever room is left, e.g. to say what was left
+        out.
+        """
+        self.parts.append(text)
+        self.size += len(text)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+class RingBuffer(object):
+    """A file-like object keeping only the last ``limit`` characters
+    written to it (0 for no limit), so a test that prints in a loop can't
+    use up memory.
+    """
+
+    encoding = 'utf-8'
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, text):
+        if not self.limit:
+            self.chunks.append(text)
+            self.size += len(text)
+            return
+        if len(text) > self.limit:
+            self.dropped += len(text) - self.limit
+            text = text[len(text) - self.limit:]
+        self.chunks.append(text)
+        self.size += len(text)
+        while self.size > self.limit:
+            excess = self.size - self.limit
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                excess = len(first)
+            else:
+                self.chunks[0] = first[excess:]
+            self.size -= excess
+            self.dropped += excess
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        text = ''.join(self.chunks)
+        if self.dropped:
+            return '[... %d characters dropped ...]\n%s' % (
+                self.dropped, text)
+        return text
+
+
+class OutputCapture(object):
+    """Captures what a test writes to stdout and stderr, if ``streams``,
+    and logs, if ``log``, each into a RingBuffer of ``limit`` characters.
+
+    Only records the root logger lets through are captured; its level isn't
+    changed. Each start() begins afresh, and stop() throws away what was
+    captured.
+    """
+
+    log_format = '%(name)s: %(levelname)s: %(message)s'
+
+    def __init__(self, limit, streams=True, log=True):
+        self.limit = limit
+        self.streams = streams
+        self.log = log
+        self.buffers = []
+        self.running = False
+        self._saved_streams = None
+        self._handler = None
+
+    def start(self):
+        self.stop()
+        self.buffers = []
+        if self.streams:
+            stdout, stderr = RingBuffer(self.limit), RingBuffer(self.limit)
+            self.buffers += [('stdout', stdout), ('stderr', stderr)]
+            self._saved_streams = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = stdout, stderr
+        if self.log:
+            records = RingBuffer(self.limit)
+            self.buffers.append(('logging', records))
+            self._handler = logging.StreamHandler(records)
+            self._handler.setFormatter(logging.Formatter(self.log_format))
+            logging.getLogger().addHandler(self._handler)
+        self.running = True
+
+    def stop(self):
+        if self._saved_streams is not None:
+            sys.stdout, sys.stderr = self._saved_streams
+            self._saved_streams = None
+        if self._handler is not None:
+            logging.getLogger().removeHandler(self._handler)
+            self._handler = None
+        self.buffers = []
+        self.running = False
+
+    def captured(self):
+        """Return ``(stream, text)`` for each stream written to since
+        start().
+        """
+        return [(name, buffer.getvalue()) for name, buffer in self.buffers
+                if buffer.size]
+
+
+def _proc_status_bytes(field):
+    """Read a size, such as VmRSS, from Linux's /proc/self/status."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def current_rss():
+    """Bytes of memory the process has resident now, or None if unknown."""
+    return _proc_status_bytes('VmRSS')
+
+
+def peak_rss():
+    """The most bytes the process has had resident, or None if unknown."""
+    peak = _proc_status_bytes('VmHWM')
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            # Linux and the BSDs count in kilobytes, OS X in bytes
+            peak *= 1024
+    return peak
+
+
+def reset_peak_rss():
+    """Start peak_rss() again from the current RSS, where Linux allows it.
+    Returns whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class MemoryProbe(object):
+    """Measures how far a test pushes the process's peak resident memory
+    above what it was using when the test started, and, if ``top_sites``,
+    which lines allocated the most of what the test left allocated.
+
+    Where the peak can't be reset (anywhere but Linux), this is how much
+    the process's peak grew instead, which is 0 for a test that stays under
+    an earlier test's peak.
+    """
+
+    def __init__(self, top_sites=0):
+        self.top_sites = top_sites
+        self._baseline = None
+        self._snapshot = None
+        self._started_tracing = False
+
+    def start(self):
+        if reset_peak_rss():
+            self._baseline = current_rss()
+        else:
+            self._baseline = peak_rss()
+        if self.top_sites:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        """Return ``(bytes, sites)``: how many bytes the peak rose by, or
+        None if unknown, and ``(line, bytes)`` for the top allocation sites.
+        """
+        peak = peak_rss()
+        growth = None
+        if peak is not None and self._baseline is not None:
+            growth = max(peak - self._baseline, 0)
+        sites = []
+        if self._snapshot is not None:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__)])
+            sites = [
+                (str(stat.traceback), stat.size_diff)
+                for stat in snapshot.compare_to(self._snapshot, 'lineno')
+                [:self.top_sites]
+                if stat.size_diff > 0]
+            self._snapshot = None
+        return growth, sites
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+class TimedOut(BaseException):
+    """Raised in a test that ran for longer than its timeout.
+
+    Not an Exception, so that a test's ``except Exception:`` doesn't
+    swallow it.
+    """
+
+    def __str__(self):
+        if self.args:
+            return 'test took longer than %g seconds' % self.args
+        return 'test took longer than its timeout'
+
+
+def timeout(seconds):
+    """Decorate a test function, method or class to give it its own
+    timeout, overriding ``%nose --timeout``.
+    """
+    def decorate(test):
+        test.timeout = seconds
+        return test
+    return decorate
+
+
+def timeout_for(test, default=None):
+    """The timeout for ``test``, a nose test: its own, given with the
+    timeout decorator or a ``timeout`` attribute, or else ``default``.
+    """
+    case = getattr(test, 'test', test)
+    method_name = getattr(case, '_testMethodName', None)
+    for owner in (
+            # A function, or a method and its class, as nose wraps them
+            getattr(case, 'test', None), getattr(case, 'method', None),
+            getattr(case, 'cls', None),
+            # A unittest.TestCase method, and its class
+            method_name and getattr(case, method_name, None),
+            method_name and type(case)):
+        seconds = getattr(owner, 'timeout', None)
+        if isinstance(seconds, (int, float)) and seconds > 0:
+            return seconds
+    return default
+
+
+# PyThreadState_SetAsyncExc takes an unsigned thread id from Python 3.7 on
+_thread_id_type = ctypes.c_ulong if sys.version_info >= (3, 7) \
+    else ctypes.c_long
+
+
+class Watchdog(object):
+    """Interrupts a test that runs for longer than it is allowed, by raising
+    TimedOut in the thread running it.
+
+    In the main thread this uses SIGALRM, which also breaks into sleeps and
+    most blocking calls. Elsewhere, e.g. in background runs, a timer thread
+    sets an asynchronous exception instead, which only takes effect once
+    the test runs some Python code. A timer that goes off as the test
+    finishes can't be cancelled, so it only interrupts while it's still the
+    one armed, and disarming takes back an interruption not yet delivered.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self._previous_handler = None
+        self._signal_armed = False
+        self._timer = None
+        # Guards which timer is armed, and which thread it interrupted
+        self._lock = threading.Lock()
+        self._armed = None
+        self._interrupted = None
+
+    def arm(self, seconds):
+        self.disarm()
+        try:
+            self._previous_handler = signal.signal(
+                signal.SIGALRM, self._alarm)
+        except (AttributeError, ValueError):
+            # Not the main thread, or no SIGALRM (Windows)
+            token = object()
+            with self._lock:
+                self._armed = token
+            self._timer = threading.Timer(
+                seconds, self._interrupt,
+                (threading.current_thread().ident, token))
+            self._timer.daemon = True
+            self._timer.start()
+            return
+        self._signal_armed = True
+        self._seconds = seconds
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    def disarm(self):
+        if self._signal_armed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler or
+                          signal.SIG_DFL)
+            self._signal_armed = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            try:
+                with self._lock:
+                    self._armed = None
+                    thread_id, self._interrupted = self._interrupted, None
+                    if thread_id is not None:
+                        # Too late to stop the test, and not to go off in
+                        # whatever runs next
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                            _thread_id_type(thread_id), None)
+            except TimedOut:
+                # Delivered on the way here, after the test had finished
+                pass
+
+    def _alarm(self, signum, frame):
+        if self._signal_armed:
+            raise TimedOut(self._seconds)
+
+    def _interrupt(self, thread_id, token):
+        with self._lock:
+            if self._armed is not token:
+                # Disarmed while this timer was going off
+                return
+            self._armed = None
+            self._interrupted = thread_id
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                _thread_id_type(thread_id), ctypes.py_object(TimedOut))
+
+
+class PhaseTimer(object):
+    """Adds up the time spent in each phase of a run, and how many times
+    each was entered.
+    """
+
+    def __init__(self):
+        # name -> [seconds, times entered]
+        self.phases = {}
+        # In the order they were first entered (no OrderedDict in 2.6)
+        self.names = []
+
+    def add(self, name, seconds):
+        if name not in self.phases:
+            self.phases[name] = [0.0, 0]
+            self.names.append(name)
+        phase = self.phases[name]
+        phase[0] += seconds
+        phase[1] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = timer()
+        try:
+            yield
+        finally:
+            self.add(name, timer() - started)
+
+    def seconds(self, name):
+        return self.phases.get(name, (0.0, 0))[0]
+
+    def items(self):
+        """Return ``(name, [seconds, times entered])`` for each phase, in
+        the order they were first entered.
+        """
+        return [(name, self.phases[name]) for name in self.names]
+
+
+class TimedLiveOutput(object):
+    """Wraps a live output, timing the calls into each of its methods as a
+    phase of their own.
+    """
+
+    def __init__(self, live_output, phases):
+        self.live_output = live_output
+        self.phases = phases
+
+    def _timed(self, method, *args):
+        started = timer()
+        try:
+            return getattr(self.live_output, method)(*args)
+        finally:
+            self.phases.add('live output: ' + method, timer() - started)
+
+    def write_chars(self, chars):
+        return self._timed('write_chars', chars)
+
+    def write_line(self, line):
+        return self._timed('write_line', line)
+
+    def flush(self):
+        return self._timed('flush')
+
+    def finalize(self):
+        return self._timed('finalize')
+
+
+def function_name(function):
+    """Name a function the way pstats keys it, ``(file, line, name)``,
+    leaving out the file's directory.
+    """
+    filename, line, name = function
+    if filename == '~':
+        # Built in
+        return pstats.func_std_string(function)
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+
+def format_bytes(size):
+    for unit in ('bytes', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            if unit == 'bytes':
+                return '%d %s' % (size, unit)
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GiB' % size
+
+
+class FailureRecord(object):
+    """What is kept of a failed test.
+
+    The traceback is formatted straight away so that the frames, and
+    everything their locals refer to, can be freed. ``exc_info`` is only
+    kept when asked for, e.g. to debug the failure post mortem.
+    ``captured`` is ``(stream, text)`` for what the test printed or logged.
+    """
+
+    __slots__ = (
+        'test_id', 'name', 'exc_type', 'message', 'formatted_traceback',
+        'exc_info', 'captured')
+
+    def __init__(self, test_id, name, exc_type, message, formatted_traceback,
+                 exc_info=None, captured=()):
+        self.test_id = test_id
+        self.name = name
+        self.exc_type = exc_type
+        self.message = message
+        self.formatted_traceback = formatted_traceback
+        self.exc_info = exc_info
+        self.captured = captured
+
+    @classmethod
+    def from_exc_info(cls, test, err, keep_exc_info=False):
+        exc_type, exc_value, tb = err
+        message = ''.join(
+            traceback.format_exception_only(exc_type, exc_value)).strip()
+        return cls(
+            test.id(), test.shortDescription() or str(test),
+            exc_type.__name__, message,
+            ''.join(traceback.format_exception(exc_type, exc_value, tb)),
+            err if keep_exc_info else None)
+
+    # Live frames can't be sent from worker processes, and without these
+    # older picklers can't handle __slots__ at all
+    def __getstate__(self):
+        return (self.test_id, self.name, self.exc_type, self.message,
+                self.formatted_traceback, None, self.captured)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return '<FailureRecord %s: %s>' % (self.test_id, self.message)
+
+    def to_dict(self):
+        return {
+            'id': self.test_id,
+            'name': self.name,
+            'exc_type': self.exc_type,
+            'message': self.message,
+            'traceback': self.formatted_traceback,
+            'captured': [list(item) for item in self.captured],
+        }
+
+
+class RemoteTest(object):
+    """Stands in for a test that was run by a worker process."""
+
+    def __init__(self, test_id, name, description):
+        self.test_id = test_id
+        self.name = name
+        self.description = description
+
+    def id(self):
+        return self.test_id
+
+    def shortDescription(self):
+        return self.description
+
+    def __str__(self):
+        return self.name
+
+
 class IPythonDisplay(Plugin):
     """Do something nice in IPython."""
 
@@ -101,13 +1088,89 @@ class IPythonDisplay(Plugin):
     enabled = True
     score = 2
 
-    def __init__(self, verbose=False):
+    # Failures shown per page of the report; 0 shows them all
+    page_size = 20
+    # Number of slowest tests listed in the report; 0 lists none
+    slowest = 5
+    # Most characters a displayed report may take up; 0 for no limit
+    max_report_size = 1000000
+    # Characters of each test's stdout, stderr and logging kept
+    capture_limit = 10000
+    # Number of tests using the most memory listed in the report, when
+    # memory is profiled
+    heaviest = 5
+    # Number of functions listed in the report, when tests are profiled
+    profiled_functions = 10
+
+    def __init__(self, verbose=False, live_batch=None, live_interval=None,
+                 page_size=None, keep_frames=False, slowest=None,
+                 report_file=None, history=None, max_report_size=None,
+                 capture=False, capture_logging=False, capture_limit=None,
+                 profile_memory=False, memory_sites=0, heaviest=None,
+                 timeout=None, live_transport=None, phases=None,
+                 profile_tests=False, profile_output=None):
         super(IPythonDisplay, self).__init__()
         self.verbose = verbose
+        # Not self.report, which nose would call as its report hook
+        self.report_file = report_file
+        self.history = history
+        # Tests found flaky, and (seconds, median seconds, test id) for
+        # tests that were slower than usual, going by the history
+        self.flaky = []
+        self.regressions = []
+        self.live_output = None
+        self.test_result = None
+        self.stopped = False
+        if page_size is not None:
+            self.page_size = page_size
+        if slowest is not None:
+            self.slowest = slowest
+        if max_report_size is not None:
+            self.max_report_size = max_report_size
+        if capture_limit is not None:
+            self.capture_limit = capture_limit
+        self._capture = None
+        if capture or capture_logging:
+            self._capture = OutputCapture(
+                self.capture_limit, streams=capture, log=capture_logging)
+        if heaviest is not None:
+            self.heaviest = heaviest
+        # (bytes the test's peak memory rose by, top allocation sites) by
+        # test id, when profiling memory
+        self.memory = {}
+        self._memory = None
+        if profile_memory or memory_sites:
+            self._memory = MemoryProbe(memory_sites)
+        # Always there, so that tests with a timeout of their own get it
+        self._watchdog = Watchdog(timeout)
+        # A PhaseTimer, when the run is profiled, and the stats of the
+        # tests themselves and where they are saved, when they are too
+        self.phases = phases
+        self._profiler = cProfile.Profile() if profile_tests else None
+        # When the body of the current test started, if it's being timed
+        self._body_started = None
+        self.profile_output = profile_output
+        self.profile_stats = None
+        self.keep_frames = keep_frames
+        # Seconds taken by each test, by test id, and by each context
+        # (module or class, including its fixtures), by name
+        self.timings = {}
+        self.context_timings = {}
+        self._test_started = None
+        self._context_started = []
+        self.live_batch = live_batch
+        self.live_interval = live_interval
+        # 'display' or 'javascript', for how live output reaches the
+        # notebook; None for the best the frontend can do
+        self.live_transport = live_transport
         self.html = []
         self.num_tests = 0
         self.failures = []
         self.skipped = 0
+        self.outcomes = {}
+        # Results reused from an earlier incremental run
+        self.cached_tests = 0
+        self.cached_skipped = 0
 
     _nose_css = '''\
     <style type="text/css">
@@ -178,6 +1241,9 @@ class IPythonDisplay(Plugin):
             border-radius: 4px 4px 0 0;
             border-top: 10px solid #cf0404;
         }
+        pre.nosecaptured {
+            border-left-color: #888;
+        }
         pre.nosetraceback {
             border-radius: 0 4px 4px 4px;
             border-left: 10px solid #cf0404;
@@ -186,13 +1252,30 @@ class IPythonDisplay(Plugin):
             margin-top: 0px;
             display: none;
         }
+        div.nosepages {
+            margin-top: 1ex;
+            font-style: italic;
+        }
+        div.noseslowest {
+            margin-top: 1ex;
+        }
+        div.noseslowest td {
+            padding: 0 1em 0 0;
+        }
+        div.nosehistory {
+            margin-top: 1ex;
+        }
+        div.nosehistory td {
+            padding: 0 1em 0 0;
+        }
     </style>
     '''
 
     _show_hide_js = '''
     <script>
         setTimeout(function () {
-            $('.nosefailtoggle').bind(
+            // unbind first: each page of failures runs this again
+            $('.nosefailtoggle').unbind('click').bind(
                 'click',
                 function () {
                     $(
@@ -208,6 +1291,32 @@ class IPythonDisplay(Plugin):
     </script>
     '''
 
+    _frame_links_js = '''
+    <script>
+        setTimeout(function () {
+            // One pass over the prompts, however many frames there are
+            var prompts = {};
+            $('div.prompt.input_prompt').each(function () {
+                var number = /\\[(\\d+)\\]/.exec($(this).text());
+                if (number) {
+                    prompts[number[1]] = $(this);
+                }
+            });
+            $('a.noseframe').each(function () {
+                var prompt = prompts[$(this).attr('data-cell')];
+                var anchor = $(this).attr('href').slice(1);
+                if (!prompt || document.getElementById(anchor)) {
+                    return;
+                }
+                var line = prompt.closest('div.cell')
+                    .find('.CodeMirror-code').children()
+                    .eq(parseInt($(this).attr('data-line'), 10) - 1);
+                (line.length ? line : prompt).attr('id', anchor);
+            });},
+            0);
+    </script>
+    '''
+
     _summary_template_html = Template('''
     <div class="noseresults">
       <div class="nosebar fail leftmost" style="width: {failpercent:d}%">
@@ -225,12 +1334,15 @@ class IPythonDisplay(Plugin):
 
     _summary_template_text = Template('''{text}\n''')
 
-    def _summary(self, numtests, numfailed, numskipped, template):
+    def _summary(self, numtests, numfailed, numskipped, template,
+                 numcached=0):
         text = "%d/%d tests passed" % (numtests - numfailed, numtests)
         if numfailed > 0:
             text += "; %d failed" % numfailed
         if numskipped > 0:
             text += "; %d skipped" % numskipped
+        if numcached > 0:
+            text += "; %d cached" % numcached
 
         failpercent = int(float(numfailed) / numtests * 100)
         if numfailed > 0 and failpercent < 5:
@@ -254,68 +1366,297 @@ class IPythonDisplay(Plugin):
           failed: <span class="nosefailedfunc">{name!e}</span>
             [<a class="nosefailtoggle" href="#">toggle traceback</a>]
         </div>
-        <pre class="nosetraceback">{formatted_traceback!e}</pre>
+        <pre class="nosetraceback">{formatted_traceback!l}</pre>{captured}
     </div>
     ''')
 
     _tracebacks_template_text = Template(
-        '''========\n{name}\n========\n{formatted_traceback}\n''')
+        '''========\n{name}\n========\n{formatted_traceback}\n{captured}''')
+
+    _captured_template_html = Template('''
+        <pre class="nosetraceback nosecaptured">captured {stream!e}:
+{text!e}</pre>''')
+
+    _captured_template_text = Template(
+        '''-------- captured {stream} --------\n{text}\n''')
+
+    def _tracebacks(self, failures, template, captured_template=None):
+        output = BoundedOutput()
+        self._write_tracebacks(failures, template, output, captured_template)
+        return output.getvalue()
+
+    def _write_tracebacks(self, failures, template, output,
+                          captured_template=None):
+        """Write ``failures`` to ``output`` for as long as they fit,
+        returning how many did.
+
+        A traceback too long for the room left is clipped, rather than
+        leaving a single huge failure out altogether.
+        """
+        for shown, failure in enumerate(failures):
+            formatted_traceback = failure.formatted_traceback
+            room = output.room()
+            if room is not None and len(formatted_traceback) > room:
+                # Escaping can make it grow, so leave some slack
+                formatted_traceback = clip(formatted_traceback, room // 2)
+            captured = ''
+            if captured_template is not None:
+                captured = ''.join(
+                    captured_template.format(stream=stream, text=text)
+                    for stream, text in failure.captured)
+            if not output.write(template.format(
+                    name=failure.name,
+                    formatted_traceback=formatted_traceback,
+                    captured=captured)):
+                return shown
+        return len(failures)
+
+    _truncated_template_html = Template('''
+    <div class="nosepages">
+      Showing {shown:d} of the {total:d} failures here, to keep the output
+      under {limit:d} characters. Display this result's
+      <code>{next_failure!e}</code> for the next one, and so on, or pass a
+      bigger <code>--max-report-size</code>.
+    </div>
+    ''')
 
-    def _tracebacks(self, failures, template):
-        output = []
-        for test, exc in failures:
-            name = test.shortDescription() or str(test)
-            formatted_traceback = ''.join(traceback.format_exception(*exc))
-            output.append(template.format(
-                name=name, formatted_traceback=formatted_traceback
-            ))
-        return ''.join(output)
+    _truncated_template_text = Template(
+        '''Showing {shown:d} of the {total:d} failures here, to keep the '''
+        '''output under {limit:d} characters. Display this result's '''
+        '''{next_failure} for the next one, and so on, or pass a bigger '''
+        '''--max-report-size.\n''')
 
-    def addSuccess(self, test):
+    _pages_template_html = Template('''
+    <div class="nosepages">
+      Showing failures {first:d}-{last:d} of {total:d}.
+      To see more, display this result's <code>{next_page!e}</code>.
+    </div>
+    ''')
+
+    _pages_template_text = Template(
+        '''Showing failures {first:d}-{last:d} of {total:d}. '''
+        '''To see more, display this result's {next_page}.\n''')
+
+    def _page_failures(self, number, page_size=None):
+        if page_size is None:
+            page_size = self.page_size
+        if not page_size:
+            return self.failures
+        start = (number - 1) * page_size
+        return self.failures[start:start + page_size]
+
+    @staticmethod
+    def _page_call(number, page_size=None):
+        if page_size is None:
+            return '.page(%d)' % number
+        return '.page(%d, page_size=%d)' % (number, page_size)
+
+    def _pages(self, number, template, page_size=None):
+        size = self.page_size if page_size is None else page_size
+        if not size:
+            return ''
+        first = (number - 1) * size + 1
+        last = min(number * size, len(self.failures))
+        if last >= len(self.failures):
+            return ''
+        return template.format(
+            first=first, last=last, total=len(self.failures),
+            next_page=self._page_call(number + 1, page_size))
+
+    def page(self, number, page_size=None):
+        """Return the given page of this run's failures, for display,
+        counting from 1, or back from -1 for the last page.
+
+        Pages are ``page_size`` failures long, or this run's page size if
+        not given; 0 puts every failure on page 1.
+        """
+        size = self.page_size if page_size is None else page_size
+        if size < 0:
+            raise ValueError("page size can't be negative: %r" % size)
+        if number < 0:
+            pages = 1
+            if size:
+                pages = max((len(self.failures) + size - 1) // size, 1)
+            number += pages + 1
+            if number < 1:
+                raise ValueError('there are only %d pages' % pages)
+        elif number == 0:
+            raise ValueError('pages count from 1, or back from -1')
+        return FailurePage(self, number, page_size)
+
+    def _page(self, number, output, tracebacks_template, captured_template,
+              pages_template, truncated_template, page_size=None):
+        failures = self._page_failures(number, page_size)
+        shown = self._write_tracebacks(
+            failures, tracebacks_template, output, captured_template)
+        if output.truncated:
+            # On pages of one, a traceback too long for the limit is
+            # clipped rather than left out, so each can be shown that way
+            size = self.page_size if page_size is None else page_size
+            first = (number - 1) * size if size else 0
+            output.write_marker(truncated_template.format(
+                shown=shown, total=len(failures), limit=output.limit,
+                next_failure=self._page_call(first + shown + 1, 1)))
+        else:
+            output.write(self._pages(number, pages_template, page_size))
+
+    def _page_html(self, number, output, page_size=None):
+        self._page(
+            number, output, self._tracebacks_template_html,
+            self._captured_template_html, self._pages_template_html,
+            self._truncated_template_html, page_size)
+
+    def _page_text(self, number, output, page_size=None):
+        self._page(
+            number, output, self._tracebacks_template_text,
+            self._captured_template_text, self._pages_template_text,
+            self._truncated_template_text, page_size)
+
+    _live_chars = {'pass': '.', 'fail': 'F', 'error': 'E', 'skip': 'S'}
+    _live_words = {
+        'pass': 'pass', 'fail': 'fail', 'error': 'error', 'skip': 'SKIP'}
+
+    def _test_seconds(self):
+        if self._test_started is None:
+            # A fixture failed outside of any test
+            return None
+        return timer() - self._test_started
+
+    def _record_result(self, test, outcome, failure=None, seconds=None):
+        self.outcomes[test.id()] = outcome
+        if self.report_file is not None:
+            if seconds is None:
+                seconds = self._test_seconds()
+            self.report_file.add(test, outcome, seconds, failure)
         if self.verbose:
-            self.live_output.write_line(str(test) + " ... pass")
+            self.live_output.write_line(
+                str(test) + " ... " + self._live_words[outcome])
         else:
-            self.live_output.write_chars('.')
+            self.live_output.write_chars(self._live_chars[outcome])
+        if outcome == 'skip':
+            self.skipped += 1
+        elif outcome != 'pass':
+            self.failures.append(failure)
+
+    def _test_finished(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self._body_started is not None:
+            self.phases.add('tests', timer() - self._body_started)
+            self._body_started = None
+        if self._watchdog is not None:
+            self._watchdog.disarm()
+
+    def addSuccess(self, test):
+        self._test_finished()
+        self._record_result(test, 'pass')
+
+    def _failure_record(self, test, err):
+        failure = FailureRecord.from_exc_info(
+            test, err, keep_exc_info=self.keep_frames)
+        if self._capture is not None and self._capture.running:
+            failure.captured = self._capture.captured()
+        return failure
 
     def addError(self, test, err):
+        self._test_finished()
         if issubclass(err[0], SkipTest):
             return self.addSkip(test)
-        if self.verbose:
-            self.live_output.write_line(str(test) + " ... error")
-        else:
-            self.live_output.write_chars('E')
-        self.failures.append((test, err))
+        self._record_result(test, 'error', self._failure_record(test, err))
 
     def addFailure(self, test, err):
-        if self.verbose:
-            self.live_output.write_line(str(test) + " ... fail")
-        else:
-            self.live_output.write_chars('F')
-        self.failures.append((test, err))
+        self._test_finished()
+        self._record_result(test, 'fail', self._failure_record(test, err))
 
     # Deprecated in newer versions of nose; skipped tests are handled in
     # addError in newer versions
     def addSkip(self, test):
-        if self.verbose:
-            self.live_output.write_line(str(test) + " ... SKIP")
-        else:
-            self.live_output.write_chars('S')
-        self.skipped += 1
+        self._test_finished()
+        self._record_result(test, 'skip')
 
     def begin(self):
+        # Background runs set up live output before starting, so that it
+        # goes to the cell that started them
+        if self.live_output is None:
+            self.live_output = self._make_live_output()
+        if self.phases is not None and \
+                not isinstance(self.live_output, TimedLiveOutput):
+            self.live_output = TimedLiveOutput(self.live_output, self.phases)
+
+    def _make_live_output(self):
         # This feels really hacky
-        try: # >= ipython 1.0
-            from IPython.kernel.zmq.displayhook import ZMQShellDisplayHook
+        try: # >= ipython 4.0
+            from ipykernel.displayhook import ZMQShellDisplayHook
         except ImportError:
-            from IPython.zmq.displayhook import ZMQShellDisplayHook
+            try: # >= ipython 1.0
+                from IPython.kernel.zmq.displayhook import ZMQShellDisplayHook
+            except ImportError:
+                try:
+                    from IPython.zmq.displayhook import ZMQShellDisplayHook
+                except ImportError:
+                    # No kernel at all, e.g. when running notebooks in batch
+                    ZMQShellDisplayHook = ()
         if isinstance(sys.displayhook, ZMQShellDisplayHook):
-            self.live_output = NotebookLiveOutput()
-        else:
-            self.live_output = ConsoleLiveOutput(self)
+            if self.live_transport != 'javascript' and \
+                    update_display is not None:
+                return DisplayLiveOutput(flush_interval=self.live_interval)
+            if self.live_batch is None and self.live_interval is None:
+                return NotebookLiveOutput()
+            return NotebookLiveOutput(
+                flush_every=self.live_batch,
+                flush_interval=self.live_interval)
+        return ConsoleLiveOutput(self, flush_interval=self.live_interval)
+
+    def prepareTestResult(self, result):
+        self.test_result = result
+        if self.stopped:
+            result.stop()
+
+    def stop(self):
+        """Stop the run after the test that is running now."""
+        self.stopped = True
+        if self.test_result is not None:
+            self.test_result.stop()
 
     def finalize(self, result):
         self.result = result
+        if self._capture is not None:
+            self._capture.stop()
+        if self._memory is not None:
+            self._memory.close()
         self.live_output.finalize()
+        if self.history is not None:
+            # One read of the history and one write per run
+            runs = self.history.recent()
+            self.flaky = self.history.flaky_tests(self.outcomes, runs)
+            self.regressions = self.history.duration_regressions(
+                self.timings, runs)
+            self.history.record(self.outcomes, self.timings)
+        if self.report_file is not None:
+            self.report_file.close()
+        if self._profiler is not None:
+            try:
+                self.profile_stats = pstats.Stats(self._profiler)
+            except TypeError:
+                # No tests ran
+                self.profile_stats = None
+            if self.profile_stats is not None and self.profile_output:
+                self.profile_stats.dump_stats(self.profile_output)
+        if _batch_results is not None:
+            _batch_results.append(self)
+
+    def to_dict(self):
+        """Return the results as plain data, e.g. to write out as JSON."""
+        return {
+            'tests': self.num_tests + self.cached_tests,
+            'failed': len(self.failures),
+            'skipped': self.skipped + self.cached_skipped,
+            'cached': self.cached_tests,
+            'outcomes': self.outcomes,
+            'timings': self.timings,
+            'failures': [failure.to_dict() for failure in self.failures],
+            'flaky': self.flaky,
+        }
 
     def setOutputStream(self, stream):
         # grab for own use
@@ -323,88 +1664,1917 @@ class IPythonDisplay(Plugin):
         return DummyUnittestStream()
 
     def startContext(self, ctx):
-        pass
+        self._context_started.append(timer())
+        if self._capture is not None and not self._capture.running:
+            # For the fixtures, until the first test
+            self._capture.start()
 
     def stopContext(self, ctx):
-        pass
+        name = getattr(ctx, '__name__', str(ctx))
+        self.context_timings[name] = timer() - self._context_started.pop()
 
     def startTest(self, test):
         self.num_tests += 1
+        if self._capture is not None:
+            self._capture.start()
+        if self._memory is not None:
+            self._memory.start()
+        self._test_started = timer()
+        if self._watchdog is not None:
+            seconds = timeout_for(test, self._watchdog.default)
+            if seconds:
+                self._watchdog.arm(seconds)
+        if self.phases is not None:
+            # Up to the first result hook, which the live output and the
+            # report are written from
+            self._body_started = timer()
+        if self._profiler is not None:
+            self._profiler.enable()
 
     def stopTest(self, test):
-        pass
+        self._test_finished()
+        self.timings[test.id()] = timer() - self._test_started
+        self._test_started = None
+        if self._memory is not None:
+            self.memory[test.id()] = self._memory.stop()
+        if self._capture is not None:
+            # Throws away what passing tests wrote, and captures fixtures
+            # run before the next test separately
+            self._capture.start()
+
+    _frame_link_template = Template(
+        '''<a class="noseframe" href="#{anchor!e}" data-cell="{cell!e}" '''
+        '''data-line="{line!e}" title="{title!e}">{name!e}</a>''')
 
     @staticmethod
     def make_link(matches):
-        target = matches.group(0)
-        input_id = matches.group(1)
-        link = '<a href="#{target}">{target}</a>'.format(target=target)
-        make_anchor_js = '''<script>
-            $("div.prompt.input_prompt:contains([{input_id}])")
-                .attr("id", "{target}");
-            </script>'''.format(input_id=input_id, target=target)
-        return link + make_anchor_js
+        """Link a frame's cell name to the line it names, or to the cell if
+        no line follows it. _frame_links_js puts the anchors in place.
+        """
+        name, cell, line = matches.group(0, 1, 2)
+        if line is None:
+            anchor, line, title = name, '', ''
+        else:
+            anchor = '%s-%s' % (name, line)
+            title = _cell_index.line(name, int(line)) or ''
+        return IPythonDisplay._frame_link_template.format(
+            anchor=anchor, cell=cell, line=line, title=title, name=name)
 
     def linkify_html_traceback(self, html):
-        return re.sub(
-            r'ipython-input-(\d+)-[0-9a-f]{12}',
-            self.make_link,
-            html)
+        return _input_name.sub(self.make_link, html)
 
-    def _repr_html_(self):
-        if self.num_tests <= 0:
-            return 'No tests found.'
+    _slowest_template_html = Template('''
+    <div class="noseslowest">
+      slowest tests:
+      <table>{rows}</table>
+    </div>
+    ''')
+
+    _slowest_row_template_html = Template(
+        '''<tr><td>{seconds:.3f}s</td><td>{name!e}</td></tr>''')
 
-        output = [self._nose_css, self._show_hide_js]
+    _slowest_template_text = Template('''Slowest tests:\n{rows}''')
 
-        output.append(self._summary(
-            self.num_tests, len(self.failures), self.skipped,
-            self._summary_template_html))
-        output.append(self.linkify_html_traceback(self._tracebacks(
-            self.failures, self._tracebacks_template_html)))
+    _slowest_row_template_text = Template('''  {seconds:.3f}s {name}\n''')
+
+    def slowest_tests(self, count=None):
+        """Return ``(seconds, test id)`` for the slowest tests, slowest
+        first.
+        """
+        if count is None:
+            count = self.slowest
+        return sorted(
+            ((seconds, name) for name, seconds in self.timings.items()),
+            reverse=True)[:count]
+
+    _history_template_html = Template('''
+    <div class="nosehistory">
+      {title}:
+      <table>{rows}</table>
+    </div>
+    ''')
+
+    _flaky_row_template_html = Template('''<tr><td>{name!e}</td></tr>''')
+
+    _regression_row_template_html = Template(
+        '''<tr><td>{seconds:.3f}s</td><td>usually {usual:.3f}s</td>'''
+        '''<td>{name!e}</td></tr>''')
+
+    _history_template_text = Template('''{title}:\n{rows}''')
+
+    _flaky_row_template_text = Template('''  {name}\n''')
+
+    _regression_row_template_text = Template(
+        '''  {seconds:.3f}s (usually {usual:.3f}s) {name}\n''')
+
+    def _history(self, template, flaky_row_template,
+                 regression_row_template):
+        output = []
+        if self.flaky:
+            output.append(template.format(
+                title='flaky tests', rows=''.join(
+                    flaky_row_template.format(name=name)
+                    for name in self.flaky)))
+        if self.regressions:
+            output.append(template.format(
+                title='slower than usual', rows=''.join(
+                    regression_row_template.format(
+                        seconds=seconds, usual=usual, name=name)
+                    for seconds, usual, name in self.regressions)))
         return ''.join(output)
 
+    def _slowest(self, template, row_template):
+        slowest = self.slowest_tests()
+        if not slowest:
+            return ''
+        return template.format(rows=''.join(
+            row_template.format(seconds=seconds, name=name)
+            for seconds, name in slowest))
+
+    _heaviest_template_html = Template('''
+    <div class="noseslowest">
+      most memory (peak rise):
+      <table>{rows}</table>
+    </div>
+    ''')
+
+    _heaviest_row_template_html = Template(
+        '''<tr><td>{size!e}</td><td>{name!e}</td></tr>''')
+
+    _site_row_template_html = Template(
+        '''<tr><td></td><td><code>{site!e}</code> {size!e}</td></tr>''')
+
+    _heaviest_template_text = Template('''Most memory (peak rise):\n{rows}''')
+
+    _heaviest_row_template_text = Template('''  {size} {name}\n''')
+
+    _site_row_template_text = Template('''      {site} {size}\n''')
+
+    def heaviest_tests(self, count=None):
+        """Return ``(bytes, test id, allocation sites)`` for the tests that
+        pushed peak memory up the most, heaviest first.
+        """
+        if count is None:
+            count = self.heaviest
+        return sorted(
+            ((size, name, sites)
+             for name, (size, sites) in self.memory.items()
+             if size is not None),
+            reverse=True)[:count]
+
+    def _heaviest(self, template, row_template, site_row_template):
+        heaviest = self.heaviest_tests()
+        if not heaviest:
+            return ''
+        rows = []
+        for size, name, sites in heaviest:
+            rows.append(row_template.format(
+                size=format_bytes(size), name=name))
+            rows.extend(
+                site_row_template.format(
+                    site=site, size='+' + format_bytes(site_size))
+                for site, site_size in sites)
+        return template.format(rows=''.join(rows))
+
+    _profile_template_html = Template('''
+    <div class="noseslowest">
+      time by phase:
+      <table>{phase_rows}</table>
+      {functions}
+    </div>
+    ''')
+
+    _phase_row_template_html = Template(
+        '''<tr><td>{seconds:.3f}s</td><td>{indent}{name!e}</td></tr>''')
+
+    _functions_template_html = Template('''
+      functions taking the most time in tests ({path!e}):
+      <table>
+        <tr><th>own time</th><th>with calls</th><th>calls</th><th></th></tr>
+        {rows}
+      </table>''')
+
+    _function_row_template_html = Template(
+        '''<tr><td>{own:.3f}s</td><td>{total:.3f}s</td><td>{calls:d}</td>'''
+        '''<td><code>{name!e}</code></td></tr>''')
+
+    _profile_template_text = Template(
+        '''Time by phase:\n{phase_rows}{functions}''')
+
+    _phase_row_template_text = Template(
+        '''  {seconds:.3f}s {indent}{name}\n''')
+
+    _functions_template_text = Template(
+        '''Functions taking the most time in tests ({path}):\n'''
+        '''  own time  with calls     calls\n{rows}''')
+
+    _function_row_template_text = Template(
+        '''  {own:7.3f}s  {total:9.3f}s {calls:9d} {name}\n''')
+
+    def phase_times(self, rendering=None):
+        """Return ``(phase, seconds, part of)`` for each phase of a profiled
+        run, ending with ``rendering`` seconds if given. Running the tests
+        is split into the tests themselves, each of the live output's
+        methods, and the rest, which is fixtures, nose and this plugin;
+        these are ``part of`` ``'execution'``, and the rest of the phases
+        of nothing.
+
+        The tests are timed from the start of each one's body to its first
+        result hook, so that none of the hooks, nor the live output they
+        write, count as the tests' time too.
+        """
+        if self.phases is None:
+            return []
+        parts = [
+            (name, seconds, 'execution')
+            for name, (seconds, count) in self.phases.items()
+            if name == 'tests' or name.startswith('live output')]
+        parts.sort(key=lambda part: part[0] != 'tests')
+        times = []
+        for name, (seconds, count) in self.phases.items():
+            if name == 'tests' or name.startswith('live output'):
+                continue
+            times.append((name, seconds, None))
+            if name == 'execution':
+                rest = seconds - sum(seconds for _, seconds, _ in parts)
+                times.extend(parts)
+                times.append(
+                    ('fixtures, nose and plugin hooks', max(rest, 0.0),
+                     'execution'))
+        if rendering is not None:
+            times.append(('rendering', rendering, None))
+        return times
+
+    def top_functions(self, count=None):
+        """Return ``(own seconds, seconds including calls, calls, function
+        name)`` for the functions the tests spent the most time in, most
+        first, when they were profiled.
+        """
+        if self.profile_stats is None:
+            return []
+        if count is None:
+            count = self.profiled_functions
+        return sorted(
+            ((own, total, calls, function_name(function))
+             for function, (primitive, calls, own, total, callers)
+             in self.profile_stats.stats.items()),
+            reverse=True)[:count]
+
+    def _profile(self, template, phase_row_template, functions_template,
+                 function_row_template, indent, rendering):
+        times = self.phase_times(rendering)
+        if not times:
+            return ''
+        phase_rows = ''.join(
+            phase_row_template.format(
+                seconds=seconds, name=name, indent=indent if part_of else '')
+            for name, seconds, part_of in times)
+        functions = ''
+        top_functions = self.top_functions()
+        if top_functions:
+            functions = functions_template.format(
+                path=self.profile_output or 'not saved',
+                rows=''.join(
+                    function_row_template.format(
+                        own=own, total=total, calls=calls, name=name)
+                    for own, total, calls, name in top_functions))
+        return template.format(phase_rows=phase_rows, functions=functions)
+
+    def _repr_html_(self):
+        if self.num_tests + self.cached_tests <= 0:
+            return 'No tests found.'
+
+        started = timer()
+        output = BoundedOutput(self.max_report_size)
+        output.write(self._nose_css)
+        output.write(self._show_hide_js)
+        output.write(self._frame_links_js)
+        output.write(self._summary(
+            self.num_tests + self.cached_tests, len(self.failures),
+            self.skipped + self.cached_skipped,
+            self._summary_template_html, self.cached_tests))
+        output.write(self._history(
+            self._history_template_html, self._flaky_row_template_html,
+            self._regression_row_template_html))
+        output.write(self._slowest(
+            self._slowest_template_html, self._slowest_row_template_html))
+        output.write(self._heaviest(
+            self._heaviest_template_html, self._heaviest_row_template_html,
+            self._site_row_template_html))
+        self._page_html(1, output)
+        # Last, so that it can say how long the rest of the report took;
+        # and kept whatever room is left, since it's only a few lines
+        output.write_marker(self._profile(
+            self._profile_template_html, self._phase_row_template_html,
+            self._functions_template_html, self._function_row_template_html,
+            '&nbsp;&nbsp;&nbsp;&nbsp;', timer() - started))
+        return output.getvalue()
+
     def _repr_pretty_(self, p, cycle):
-        if self.num_tests <= 0:
+        if self.num_tests + self.cached_tests <= 0:
             p.text('No tests found.')
             return
-        p.text(self._summary(
-            self.num_tests, len(self.failures), self.skipped,
-            self._summary_template_text))
-        p.text(self._tracebacks(self.failures, self._tracebacks_template_text))
+        started = timer()
+        output = BoundedOutput(self.max_report_size)
+        output.write(self._summary(
+            self.num_tests + self.cached_tests, len(self.failures),
+            self.skipped + self.cached_skipped,
+            self._summary_template_text, self.cached_tests))
+        output.write(self._history(
+            self._history_template_text, self._flaky_row_template_text,
+            self._regression_row_template_text))
+        output.write(self._slowest(
+            self._slowest_template_text, self._slowest_row_template_text))
+        output.write(self._heaviest(
+            self._heaviest_template_text, self._heaviest_row_template_text,
+            self._site_row_template_text))
+        self._page_text(1, output)
+        output.write_marker(self._profile(
+            self._profile_template_text, self._phase_row_template_text,
+            self._functions_template_text, self._function_row_template_text,
+            '  ', timer() - started))
+        p.text(output.getvalue())
+
+
+class FailurePage(object):
+    """One page of the failures from a run, as returned by
+    IPythonDisplay.page().
+    """
+
+    def __init__(self, plugin, number, page_size=None):
+        self.plugin = plugin
+        self.number = number
+        # None for the run's own page size
+        self.page_size = page_size
+
+    def _repr_html_(self):
+        if not self.plugin._page_failures(self.number, self.page_size):
+            return 'No failures on page %d.' % self.number
+        output = BoundedOutput(self.plugin.max_report_size)
+        output.write(self.plugin._nose_css)
+        output.write(self.plugin._show_hide_js)
+        output.write(self.plugin._frame_links_js)
+        self.plugin._page_html(self.number, output, self.page_size)
+        return output.getvalue()
+
+    def _repr_pretty_(self, p, cycle):
+        if not self.plugin._page_failures(self.number, self.page_size):
+            p.text('No failures on page %d.' % self.number)
+            return
+        output = BoundedOutput(self.plugin.max_report_size)
+        self.plugin._page_text(self.number, output, self.page_size)
+        p.text(output.getvalue())
+
+
+class WorkerDisplay(IPythonDisplay):
+    """Runs in a worker process, sending each result back to the kernel
+    instead of displaying it.
+    """
+
+    name = 'ipython-nose-worker'
+
+    def __init__(self, queue, capture=None, memory=None, watchdog=None):
+        super(WorkerDisplay, self).__init__()
+        self.queue = queue
+        self._capture = capture
+        self._memory = memory
+        self._watchdog = watchdog
 
+    def _record_result(self, test, outcome, failure=None, seconds=None):
+        self.queue.put((
+            outcome, test.id(), str(test), test.shortDescription(), failure,
+            self._test_seconds()))
 
-def get_ipython_user_ns_as_a_module():
-    test_module = types.ModuleType('test_module')
-    test_module.__dict__.update(get_ipython().user_ns)
+    def stopTest(self, test):
+        super(WorkerDisplay, self).stopTest(test)
+        if self._memory is not None:
+            # Only known once the result has been sent
+            self.queue.put(('memory', test.id(), self.memory.pop(test.id())))
+
+    def begin(self):
+        pass
+
+    def finalize(self, result):
+        if self._capture is not None:
+            self._capture.stop()
+
+
+def split_suite(loader, suite, index, count):
+    """Return the share of ``suite``'s top-level tests belonging to worker
+    ``index`` of ``count``, still in the suite's context so that module
+    fixtures are run.
+
+    Test classes are kept whole so their fixtures run once per worker.
+    """
+    tests = [test for position, test in enumerate(suite)
+             if position % count == index]
+    return loader.suiteClass(ContextList(tests, context=suite.context))
+
+
+def _run_worker(loader, suite, argv, queue, index, count, probes):
+    try:
+        plug = WorkerDisplay(queue, **probes)
+        nose_core.TestProgram(
+            argv=argv + ['--with-ipython-nose-worker'],
+            suite=split_suite(loader, suite, index, count),
+            addplugins=[plug], exit=False, config=loader.config)
+    finally:
+        queue.put(('done', index))
+
+
+def run_in_processes(loader, suite, argv, plug, processes):
+    """Run ``suite`` split across ``processes`` forked workers, which
+    inherit the kernel's namespace. Results are reported through ``plug``
+    as they arrive.
+    """
+    if not hasattr(os, 'fork'):
+        raise UsageError('--processes needs a platform with os.fork')
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        context = multiprocessing
+    queue = context.Queue()
+    # Output capture, memory probes and timeouts work in the workers,
+    # around the tests themselves
+    probes = {}
+    for name in ('capture', 'memory', 'watchdog'):
+        probes[name] = getattr(plug, '_' + name)
+        setattr(plug, '_' + name, None)
+    workers = [
+        context.Process(
+            target=_run_worker,
+            args=(loader, suite, argv, queue, index, processes, probes))
+        for index in range(processes)]
+
+    def report(test, outcome, failure=None, seconds=None):
+        plug.startTest(test)
+        # The test itself ran in a worker
+        plug._body_started = None
+        plug._record_result(test, outcome, failure, seconds)
+        plug.stopTest(test)
+        if seconds is not None:
+            plug.timings[test.id()] = seconds
+
+    def handle(message):
+        if message[0] == 'done':
+            running.discard(message[1])
+        elif message[0] == 'memory':
+            plug.memory[message[1]] = message[2]
+        else:
+            outcome, test_id, name, description, failure, seconds = message
+            report(
+                RemoteTest(test_id, name, description), outcome, failure,
+                seconds)
+
+    plug.setOutputStream(sys.stderr)
+    plug.begin()
+    for worker in workers:
+        worker.start()
+    running = set(range(processes))
+    while running and not plug.stopped:
+        try:
+            handle(queue.get(timeout=1))
+        except Empty:
+            if not any(workers[index].is_alive() for index in running):
+                break
+    if plug.stopped:
+        for worker in workers:
+            worker.terminate()
+        running.clear()
+    # Pick up anything sent just before the last workers exited.
+    while True:
+        try:
+            handle(queue.get(timeout=0.1))
+        except Empty:
+            break
+    for worker in workers:
+        worker.join()
+    for index in sorted(running):
+        message = 'Worker process exited with code %s before finishing' % (
+            workers[index].exitcode)
+        test = RemoteTest('worker-%d' % index, 'worker %d' % index, None)
+        report(test, 'error', FailureRecord(
+            test.id(), str(test), 'WorkerError', message, message + '\n'))
+    plug.finalize(None)
+
+
+# Constants whose value, rather than identity, goes into a fingerprint
+_fingerprint_value_types = (
+    bool, int, float, complex, str, bytes, type(None), type(Ellipsis))
+try:
+    _fingerprint_value_types += (long, unicode)
+except NameError:
+    pass
+
+# What a class gets for __dict__, __weakref__ and __slots__ entries, which
+# can't be pickled but are the same whenever the class is defined again
+_slot_descriptor_types = (
+    types.GetSetDescriptorType, types.MemberDescriptorType)
+
+
+def fingerprint(obj, by_identity=False):
+    """Return a digest of a test function or class.
+
+    The digest covers the code (but not the file name or line numbers, which
+    change every time a cell is run), defaults, closures and the globals the
+    code refers to. Functions and classes from the same module are followed
+    recursively, classes through their bases from the same module too;
+    modules contribute their name, simple constants their value, and
+    anything else its pickle. Anything that can't be pickled makes the
+    digest different every time, so the test always counts as changed, or
+    with ``by_identity`` contributes its type and id, so only rebinding it
+    to another object counts.
+    """
+    digest = hashlib.sha1()
+    _fingerprint_value(digest, obj, getattr(obj, '__module__', None), {},
+                       by_identity)
+    return digest.hexdigest()
+
+
+def _fingerprint_update(digest, value):
+    digest.update(repr(value).encode('utf-8'))
+
+
+def _fingerprint_code(digest, code, namespace, module, seen, by_identity):
+    _fingerprint_update(digest, (
+        code.co_code, code.co_names, code.co_varnames, code.co_freevars))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _fingerprint_code(
+                digest, const, namespace, module, seen, by_identity)
+        else:
+            _fingerprint_update(digest, const)
+    for name in code.co_names:
+        if name in namespace:
+            _fingerprint_update(digest, name)
+            _fingerprint_value(
+                digest, namespace[name], module, seen, by_identity)
+
+
+def _fingerprint_value(digest, value, module, seen, by_identity):
+    if isinstance(value, _fingerprint_value_types):
+        _fingerprint_update(digest, value)
+    elif isinstance(value, types.ModuleType):
+        _fingerprint_update(digest, ('module', value.__name__))
+    elif id(value) in seen:
+        # By the order it was seen in, which is the same from run to run
+        _fingerprint_update(digest, ('seen', seen[id(value)]))
+    elif isfunction(value) and value.__module__ == module:
+        seen[id(value)] = len(seen)
+        _fingerprint_code(digest, value.__code__, value.__globals__,
+                          module, seen, by_identity)
+        for default in value.__defaults__ or ():
+            _fingerprint_value(digest, default, module, seen, by_identity)
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                # Cell not filled in yet
+                continue
+            _fingerprint_value(digest, contents, module, seen, by_identity)
+    elif isclass(value) and value.__module__ == module:
+        seen[id(value)] = len(seen)
+        # Inherited tests and helpers count as much as the class's own
+        for cls in value.__mro__:
+            _fingerprint_update(digest, (
+                'class', cls.__module__, cls.__name__))
+            if cls.__module__ != module:
+                continue
+            for name, attr in sorted(vars(cls).items()):
+                _fingerprint_update(digest, name)
+                if isinstance(attr, _slot_descriptor_types):
+                    _fingerprint_update(digest, type(attr).__name__)
+                    continue
+                # Look through staticmethod, classmethod and property
+                attr = getattr(attr, '__func__', getattr(attr, 'fget', attr))
+                _fingerprint_value(digest, attr, module, seen, by_identity)
+    else:
+        try:
+            state = pickle.dumps(value, 2)
+        except Exception:
+            if by_identity:
+                state = id(value)
+            else:
+                # Nothing to tell whether it changed, so assume it did
+                state = uuid.uuid4().hex
+        _fingerprint_update(digest, (type(value).__name__, state))
+
+
+def _top_level_name(test_id, names):
+    """Return the first identifier in ``test_id`` that is one of ``names``.
+    """
+    for part in re.findall(r'[A-Za-z_]\w*', test_id):
+        if part in names:
+            return part
+    return None
+
+
+class IncrementalCache(object):
+    """Remembers each top-level test function and class's fingerprint and
+    results between incremental runs, so that unchanged tests that passed
+    last time can be left out.
+
+    The results are only good for the selection (``--select``,
+    ``--deselect`` and ``--shard``) they were run with, which can leave out
+    some of a class's tests, so a run with another selection starts afresh.
+    """
+
+    def __init__(self):
+        self.selection = None
+        # name -> (fingerprint, num tests, num skipped, num failed)
+        self.entries = {}
+
+    def prune(self, test_module, selector, selection=None):
+        """Return a copy of ``test_module`` without the tests that can be
+        skipped, the fingerprints of the tests left in, and the numbers of
+        tests and skipped tests whose results were reused.
+        """
+        if selection != self.selection:
+            self.selection = selection
+            self.entries = {}
+        pruned = types.ModuleType(test_module.__name__)
+        pruned.__dict__.update(vars(test_module))
+        fingerprints = {}
+        cached_tests = cached_skipped = 0
+        for name, value in list(vars(test_module).items()):
+            if isclass(value):
+                wanted = selector.wantClass(value)
+            elif isfunction(value):
+                wanted = selector.wantFunction(value)
+            else:
+                continue
+            if not wanted:
+                continue
+            value_fingerprint = fingerprint(value)
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == value_fingerprint \
+                    and entry[3] == 0:
+                delattr(pruned, name)
+                cached_tests += entry[1]
+                cached_skipped += entry[2]
+            else:
+                fingerprints[name] = value_fingerprint
+        for name in list(self.entries):
+            if name not in vars(test_module):
+                del self.entries[name]
+        return pruned, fingerprints, cached_tests, cached_skipped
+
+    def record(self, fingerprints, outcomes):
+        """Remember the results of a run of the tests in ``fingerprints``.
+        """
+        counts = dict((name, [0, 0, 0]) for name in fingerprints)
+        for test_id, outcome in outcomes.items():
+            name = _top_level_name(test_id, counts)
+            if name is None:
+                continue
+            counts[name][0] += 1
+            if outcome == 'skip':
+                counts[name][1] += 1
+            elif outcome != 'pass':
+                counts[name][2] += 1
+        for name, (tests, skipped, failed) in counts.items():
+            if tests:
+                self.entries[name] = (
+                    fingerprints[name], tests, skipped, failed)
+            else:
+                # Never got as far as running, e.g. a fixture failed
+                self.entries.pop(name, None)
+
+
+_incremental_cache = IncrementalCache()
+
+
+def deep_size(obj):
+    """Estimate how many bytes ``obj`` takes up, following containers and
+    instances' attributes. Objects that know their own size, such as numpy
+    arrays and pandas frames, are taken at their word; modules, classes and
+    functions aren't counted.
+    """
+    seen = set()
+    pending = [obj]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(
+                obj, (types.ModuleType, type, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            pending.extend(obj)
+        attributes = getattr(obj, '__dict__', None)
+        if isinstance(attributes, dict):
+            pending.append(attributes)
+    return size
+
+
+class FixtureCache(object):
+    """Keeps what cached fixtures returned for the life of the kernel.
+
+    Results are keyed by the fixture's name, fingerprint and arguments, so
+    redefining a fixture, or a helper it uses, runs it again. Globals that
+    can't be pickled, such as locks or connections, count by identity. Once
+    their estimated sizes add up to more than ``budget`` bytes, the least
+    recently used results are dropped.
+    """
+
+    # Bytes of fixture results kept; 0 for no limit
+    budget = 2 ** 30
+
+    def __init__(self, budget=None):
+        if budget is not None:
+            self.budget = budget
+        # (name, fingerprint, arguments) -> (result, estimated bytes)
+        self.entries = {}
+        # Their keys, least recently used first. A list rather than an
+        # OrderedDict, which Python 2.6 doesn't have; there are only ever a
+        # handful of fixtures
+        self.order = []
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _name(function):
+        return '%s.%s' % (function.__module__, getattr(
+            function, '__qualname__', function.__name__))
+
+    def get(self, function, args=(), kwargs=None):
+        """Return what ``function(*args, **kwargs)`` returned last time, or
+        call it and keep the result.
+        """
+        kwargs = kwargs or {}
+        name = self._name(function)
+        key = (name, fingerprint(function, by_identity=True),
+               tuple(args), tuple(sorted(kwargs.items())))
+        try:
+            entry = self.entries[key]
+        except TypeError:
+            # Unhashable arguments: nothing to look the result up by
+            self.misses += 1
+            return function(*args, **kwargs)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self.order.remove(key)
+            self.order.append(key)
+            return entry[0]
+        self.misses += 1
+        result = function(*args, **kwargs)
+        # Results of earlier definitions can't be asked for again
+        for stale in [stale for stale in self.entries
+                      if stale[0] == name and stale[1] != key[1]]:
+            self._drop(stale)
+        size = deep_size(result)
+        if not self.budget or size <= self.budget:
+            self.entries[key] = (result, size)
+            self.order.append(key)
+            self.size += size
+            self.evict()
+        return result
+
+    def _drop(self, key):
+        self.size -= self.entries.pop(key)[1]
+        self.order.remove(key)
+
+    def evict(self):
+        """Drop least recently used results until the rest fit the budget.
+        """
+        while self.budget and self.size > self.budget:
+            self._drop(self.order[0])
+
+    def invalidate(self, function=None):
+        """Forget the results of ``function``, or of every fixture."""
+        if function is None:
+            self.entries.clear()
+            del self.order[:]
+            self.size = 0
+            return
+        name = self._name(function)
+        for key in [key for key in self.entries if key[0] == name]:
+            self._drop(key)
+
+
+_fixture_cache = FixtureCache()
+
+
+def cached_fixture(function):
+    """Decorate a function that sets up something expensive for tests, such
+    as loading a dataset, so that what it returns is kept between ``%nose``
+    runs. Call ``invalidate()`` on the decorated function to forget it.
+    """
+    @functools.wraps(function)
+    def cached(*args, **kwargs):
+        return _fixture_cache.get(function, args, kwargs)
+    cached.invalidate = lambda: _fixture_cache.invalidate(function)
+    return cached
+
+
+# Module-level fixtures nose looks for, which are kept in test modules
+# whether or not they look like tests
+module_fixture_names = (
+    'setup', 'setup_module', 'setupModule', 'setUp',
+    'teardown', 'teardown_module', 'teardownModule', 'tearDown',
+)
+
+
+# What IPython puts in the user namespace for itself
+_ipython_names = frozenset(['In', 'Out', 'exit', 'quit', 'get_ipython'])
+
+
+def hidden_name(name):
+    """Whether ``name``, in a notebook's namespace, can be passed over
+    without looking at its value: private names, which include IPython's
+    history (``_``, ``_i3``, ``_3`` and so on), and IPython's own entries.
+    """
+    return name.startswith('_') or name in _ipython_names
+
+
+def namespace_module(namespace, names):
+    """Make a module of just ``names`` from ``namespace``, a dict.
+
+    Copying the handful of entries a test run needs costs far less than
+    copying, or even filtering, all of a well-used kernel's namespace. The
+    module is named after the namespace (``__main__`` for the kernel's), or
+    nose would move its test classes into a module it can't import.
+    """
+    test_module = types.ModuleType(namespace.get('__name__', 'test_module'))
+    test_module.__dict__.update(
+        (name, namespace[name]) for name in names if name in namespace)
     return test_module
 
 
-def makeNoseConfig(env):
+class DiscoveryCache(object):
+    """Remembers which functions and classes in a namespace are tests, so
+    that between runs only names that were added or rebound are put to the
+    test selector again.
+
+    Only the tests, plus any module fixtures, end up in the test module,
+    so nose's loader never sees the rest of the namespace.
+    """
+
+    def __init__(self):
+        self.key = None
+        # name -> (value, whether it's a test)
+        self.entries = {}
+
+    def test_module(self, namespace, selector):
+        key = (id(namespace), selector.match.pattern)
+        if key != self.key:
+            self.key = key
+            self.entries = {}
+        entries = {}
+        names = []
+        for name, value in namespace.items():
+            if hidden_name(name):
+                continue
+            if name in module_fixture_names:
+                names.append(name)
+                continue
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] is value:
+                wanted = entry[1]
+            elif isclass(value):
+                wanted = selector.wantClass(value)
+            elif isfunction(value):
+                wanted = selector.wantFunction(value)
+            else:
+                continue
+            # Keeping the value, not its id, means a new object that
+            # happens to reuse a freed one's id can't be mistaken for it
+            entries[name] = (value, wanted)
+            if wanted:
+                names.append(name)
+        self.entries = entries
+        return namespace_module(namespace, names)
+
+
+_discovery_cache = DiscoveryCache()
+
+
+def changed_names_as_a_module(before, after):
+    """Make a module of the names in ``after`` that were added or rebound
+    since ``before``, plus any module fixtures.
+    """
+    return namespace_module(after, [
+        name for name, value in after.items()
+        if name in module_fixture_names
+        or name not in before or before[name] is not value])
+
+
+class CachedPluginManager(PluginManager):
+    """Loads fresh instances of a fixed list of plugins, instead of looking
+    for them all over again like DefaultPluginManager.
+    """
+
+    def __init__(self, factories, plugins=(), proxyClass=None):
+        self.factories = factories
+        super(CachedPluginManager, self).__init__(plugins, proxyClass)
+
+    def loadPlugins(self):
+        for factory in self.factories:
+            self.addPlugin(factory())
+        super(CachedPluginManager, self).loadPlugins()
+
+
+def _plugin_factory(plug):
+    if isinstance(plug, ZeroNinePlugin):
+        plugin_class = type(plug.plugin)
+        return lambda: ZeroNinePlugin(plugin_class())
+    return type(plug)
+
+
+class NoseConfigCache(object):
+    """Keeps what makeNoseConfig finds between runs: the contents of the
+    config files, and the plugins DefaultPluginManager loads from nose and
+    setuptools entry points. Both are found again when any config file is
+    added, removed or modified.
+    """
+
+    section = 'nosetests'
+
+    def __init__(self):
+        self.stamp = None
+        self.config_text = None
+        self.plugin_factories = None
+
+    def _stamp(self, files):
+        stamp = []
+        for filename in files:
+            try:
+                stamp.append((filename, os.stat(filename).st_mtime))
+            except OSError:
+                stamp.append((filename, None))
+        return stamp
+
+    def _read_config(self, files):
+        # Flatten the files into one, later files overriding earlier ones
+        # as they would if nose read them itself
+        parser = RawConfigParser()
+        parser.read(files)
+        if not parser.has_section(self.section):
+            return None
+        for section in parser.sections():
+            if section != self.section:
+                parser.remove_section(section)
+        text = StringIO()
+        parser.write(text)
+        return text.getvalue()
+
+    def _find_plugins(self):
+        manager = DefaultPluginManager()
+        manager.loadPlugins()
+        return [_plugin_factory(plug) for plug in manager.plugins]
+
+    def config(self, env, reload=False):
+        files = all_config_files()
+        stamp = self._stamp(files)
+        if reload or stamp != self.stamp:
+            self.config_text = self._read_config(files)
+            self.plugin_factories = self._find_plugins()
+            self.stamp = stamp
+        if self.config_text is None:
+            files = []
+        else:
+            files = StringIO(self.config_text)
+        return Config(
+            env=env, files=files,
+            plugins=CachedPluginManager(self.plugin_factories))
+
+
+_config_cache = NoseConfigCache()
+
+
+def name_matcher(pattern):
+    """Return a function matching test names against ``pattern``, a glob,
+    or a regular expression if it starts with ``re:``.
+    """
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:]).search
+    return lambda name: fnmatch.fnmatchcase(name, pattern)
+
+
+def name_pattern(value):
+    """Check that ``value`` is a pattern name_matcher can use."""
+    if value.startswith('re:'):
+        try:
+            re.compile(value[3:])
+        except re.error:
+            raise ValueError(value)
+    return value
+
+
+def parse_shard(value):
+    """Parse ``i/n`` into ``(i, n)``, where ``1 <= i <= n``."""
+    index, count = [int(part) for part in value.split('/')]
+    if not 1 <= index <= count:
+        raise ValueError(value)
+    return index, count
+
+
+def in_shard(name, shard):
+    """Whether the test ``name`` belongs in ``shard``, an ``(i, n)`` pair.
+
+    Uses a checksum of the name rather than hash(), so that every machine
+    agrees on the split.
+    """
+    index, count = shard
+    checksum = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+    return checksum % count == index - 1
+
+
+class SelectingSelector(Selector):
+    """A nose Selector that also filters tests by name and shard.
+
+    Functions are named by their own name, and methods by
+    ``Class.method``; a method also matches patterns that match its class's
+    name. A test is selected when it matches any of ``select`` (if given),
+    none of ``deselect``, and falls in ``shard``.
+    """
+
+    def __init__(self, config, select=(), deselect=(), shard=None):
+        Selector.__init__(self, config)
+        self.select = [name_matcher(pattern) for pattern in select]
+        self.deselect = [name_matcher(pattern) for pattern in deselect]
+        self.shard = shard
+
+    def _selected(self, names):
+        if self.select and not [
+                match for match in self.select for name in names
+                if match(name)]:
+            return False
+        if [match for match in self.deselect for name in names
+                if match(name)]:
+            return False
+        return self.shard is None or in_shard(names[0], self.shard)
+
+    def wantClass(self, cls):
+        if [match for match in self.deselect if match(cls.__name__)]:
+            return False
+        return Selector.wantClass(self, cls)
+
+    def wantFunction(self, function):
+        return (Selector.wantFunction(self, function)
+                and self._selected([function.__name__]))
+
+    def wantMethod(self, method):
+        if not Selector.wantMethod(self, method):
+            return False
+        # Python 2's unbound methods, or nose's stand-in for them
+        cls = getattr(method, 'im_class', None) or getattr(
+            getattr(method, '__self__', None), 'cls', None)
+        if cls is None:
+            return self._selected([method.__name__])
+        return self._selected(
+            ['%s.%s' % (cls.__name__, method.__name__), cls.__name__])
+
+
+def _suite_item_name(test, names):
+    """The top-level test function or class that ``test``, an item of a
+    module's suite, came from.
+    """
+    context = getattr(test, 'context', None)
+    if isclass(context):
+        return context.__name__
+    return _top_level_name(test.id(), names)
+
+
+def order_failed_first(loader, suite, failed_ids):
+    """Return ``suite`` with the top-level tests that had any of
+    ``failed_ids`` fail moved to the front, keeping their order otherwise.
+    """
+    names = set(vars(suite.context))
+    failed_names = set(
+        _top_level_name(test_id, names) for test_id in failed_ids)
+    tests = list(suite)
+    tests.sort(key=lambda test: _suite_item_name(test, names)
+               not in failed_names)
+    return loader.suiteClass(ContextList(tests, context=suite.context))
+
+
+class ResultHistory(object):
+    """An append-only file of past runs' results, one JSON object per line.
+
+    Only the last ``window`` runs are looked at when spotting flaky tests
+    and duration regressions, and only the end of the file they take up is
+    read, so a history that has grown long doesn't slow every run down.
+    """
+
+    # Runs looked back over
+    window = 20
+    # A test whose outcome flips between passing and failing this many
+    # times within the window is flaky
+    flaky_flips = 2
+    # A test is slower than usual if it takes this many times its median
+    # time, and at least min_regression seconds longer
+    regression_factor = 2.0
+    min_regression = 0.1
+    # Earlier timings needed before a test's time is compared
+    min_timings = 3
+    # Bytes read at a time, working back from the end of the file
+    block_size = 64 * 1024
+
+    def __init__(self, path, window=None):
+        self.path = path
+        if window is not None:
+            self.window = window
+
+    @staticmethod
+    def _parse_run(line):
+        try:
+            run = json.loads(line.decode('utf-8'))
+        except ValueError:
+            # Left half-written by a killed kernel
+            return None
+        if not isinstance(run, dict):
+            return None
+        return run
+
+    def runs(self):
+        """Yield the recorded runs, oldest first."""
+        try:
+            history = open(self.path, 'rb')
+        except IOError:
+            return
+        with history:
+            for line in history:
+                run = self._parse_run(line)
+                if run is not None:
+                    yield run
+
+    def tail(self, count):
+        """Return the last ``count`` recorded runs, oldest first."""
+        try:
+            history = open(self.path, 'rb')
+        except IOError:
+            return []
+        with history:
+            history.seek(0, os.SEEK_END)
+            position = history.tell()
+            data = b''
+            # Until there's a whole line for each run, after the first
+            # newline: what comes before it may be only part of a line
+            while position > 0 and data.count(b'\n') <= count:
+                size = min(self.block_size, position)
+                position -= size
+                history.seek(position)
+                data = history.read(size) + data
+        lines = data.split(b'\n')
+        if position > 0:
+            del lines[0]
+        runs = []
+        for line in reversed(lines):
+            run = self._parse_run(line)
+            if run is not None:
+                runs.append(run)
+                if len(runs) == count:
+                    break
+        runs.reverse()
+        return runs
+
+    def recent(self):
+        """Return the last ``window`` runs, oldest first."""
+        return self.tail(self.window)
+
+    def last_failed(self):
+        """Return the ids of the tests that failed in the last run."""
+        last = self.tail(1)
+        if not last:
+            return set()
+        return set(
+            test_id for test_id, outcome in last[0].get('outcomes', {}).items()
+            if outcome in ('fail', 'error'))
+
+    def flaky_tests(self, outcomes, runs=None):
+        """Return the ids, sorted, of the tests whose outcome flipped
+        between passing and failing at least ``flaky_flips`` times over the
+        recent runs and ``outcomes``, this run's.
+        """
+        if runs is None:
+            runs = self.recent()
+        flips = {}
+        passed = {}
+        for run_outcomes in [
+                run.get('outcomes', {}) for run in runs] + [outcomes]:
+            for test_id, outcome in run_outcomes.items():
+                if outcome == 'skip':
+                    continue
+                if test_id in passed and passed[test_id] != (
+                        outcome == 'pass'):
+                    flips[test_id] = flips.get(test_id, 0) + 1
+                passed[test_id] = outcome == 'pass'
+        return sorted(
+            test_id for test_id, count in flips.items()
+            if count >= self.flaky_flips)
+
+    def duration_regressions(self, timings, runs=None):
+        """Return ``(seconds, median seconds, test id)`` for the tests in
+        ``timings``, this run's, that took much longer than their median
+        over the recent runs, slowest first.
+        """
+        if runs is None:
+            runs = self.recent()
+        past = {}
+        for run in runs:
+            for test_id, seconds in run.get('timings', {}).items():
+                past.setdefault(test_id, []).append(seconds)
+        regressions = []
+        for test_id, seconds in timings.items():
+            previous = past.get(test_id, ())
+            if len(previous) < self.min_timings:
+                continue
+            usual = median(previous)
+            if (seconds > usual * self.regression_factor
+                    and seconds - usual >= self.min_regression):
+                regressions.append((seconds, usual, test_id))
+        return sorted(regressions, reverse=True)
+
+    def record(self, outcomes, timings=None):
+        """Append a run's outcomes and timings, both by test id."""
+        line = json.dumps(
+            {'time': time.time(), 'outcomes': outcomes,
+             'timings': timings or {}},
+            sort_keys=True)
+        with open(self.path, 'a') as history:
+            history.write(line + '\n')
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+# Where run results are kept if --history isn't given and the notebook
+# isn't known
+default_history_path = '.ipython_nose_history.jsonl'
+default_profile_path = 'ipython_nose.pstats'
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
+
+def notebook_path(namespace):
+    """The path of the notebook whose kernel has ``namespace``, as Jupyter
+    Server or VS Code tell the kernel, or None.
+    """
+    candidates = [namespace.get('__session__'),
+                  namespace.get('__vsc_ipynb_file__'),
+                  os.environ.get('JPY_SESSION_NAME')]
+    for path in candidates:
+        if isinstance(path, _string_types) and path.endswith('.ipynb'):
+            return path
+    return None
+
+
+def history_path(namespace):
+    """Where run results are kept if --history isn't given: beside the
+    notebook, named after it, so that notebooks sharing a directory (and
+    all with tests in ``__main__``) keep apart. Otherwise in the current
+    directory.
+    """
+    path = notebook_path(namespace)
+    if path is None:
+        return default_history_path
+    directory, name = os.path.split(path)
+    if not os.path.isabs(path):
+        # Relative to the server's root, but kernels start in the
+        # notebook's directory
+        directory = ''
+    return os.path.join(directory, '.%s%s' % (
+        os.path.splitext(name)[0], default_history_path))
+
+
+def makeNoseConfig(env, reload=False):
     """Load a Config, pre-filled with user config files if any are
     found.
+
+    The config files and plugins are cached between calls; pass
+    ``reload=True`` to find them again regardless.
+    """
+    return _config_cache.config(env, reload=reload)
+
+
+def non_negative_int(value):
+    """Parse a number of things, which can't be negative."""
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def positive_float(value):
+    """Parse a length of time, which has to be more than nothing."""
+    value = float(value)
+    if not value > 0:
+        raise ValueError(value)
+    return value
+
+
+def live_transport(value):
+    if value not in ('display', 'javascript'):
+        raise ValueError(value)
+    return value
+
+
+# Options handled by the %nose magic itself instead of being passed through
+# to nose. Each maps to a function converting its value, or None for flags.
+magic_options = {
+    '--live-batch': int,
+    '--live-interval': float,
+    '--live-output': live_transport,
+    '--processes': int,
+    '--incremental': None,
+    '--page-size': non_negative_int,
+    '--keep-frames': None,
+    '--slowest': non_negative_int,
+    '--report': str,
+    '--reload-config': None,
+    '--background': None,
+    '--select': name_pattern,
+    '--deselect': name_pattern,
+    '--shard': parse_shard,
+    '--history': str,
+    '--last-failed-first': None,
+    '--max-report-size': non_negative_int,
+    '--capture-limit': non_negative_int,
+    '--profile-memory': None,
+    '--memory-sites': non_negative_int,
+    '--heaviest': non_negative_int,
+    '--timeout': positive_float,
+    '--clear-fixtures': None,
+    '--fixture-budget': float,
+    '--profile': None,
+    '--profile-tests': None,
+    '--profile-output': str,
+}
+
+# Options that can be given more than once, collecting their values in a list
+repeatable_magic_options = frozenset(['--select', '--deselect'])
+
+
+def parse_magic_line(line):
+    """Split a %nose line into the magic's own options and nose's args.
+
+    Returns ``(options, nose_args)``, where ``options`` is keyed by the
+    option name without its leading dashes and with ``-`` replaced by ``_``.
     """
-    cfg_files = all_config_files()
-    manager = DefaultPluginManager()
-    return Config(env=env, files=cfg_files, plugins=manager)
+    options = {}
+    nose_args = []
+    args = shlex.split(str(line))
+    while args:
+        arg = args.pop(0)
+        name, equals, value = arg.partition('=')
+        if name not in magic_options:
+            nose_args.append(arg)
+            continue
+        convert = magic_options[name]
+        key = name.lstrip('-').replace('-', '_')
+        if convert is None:
+            options[key] = True
+            continue
+        if not equals:
+            if not args:
+                raise UsageError('%s requires a value' % name)
+            value = args.pop(0)
+        try:
+            value = convert(value)
+        except ValueError:
+            raise UsageError('invalid value for %s: %r' % (name, value))
+        if name in repeatable_magic_options:
+            options.setdefault(key, []).append(value)
+        else:
+            options[key] = value
+    return options, nose_args
 
 
-def nose(line, test_module=get_ipython_user_ns_as_a_module):
-    if callable(test_module):
-        test_module = test_module()
-    config = makeNoseConfig(os.environ)
-    loader = nose_loader.TestLoader(config=config)
-    tests = loader.loadTestsFromModule(test_module)
-    extra_args = shlex.split(str(line))
-    argv = ['ipython-nose', '--with-ipython-html', '--no-skip'] + extra_args
-    verbose = '-v' in extra_args
-    plug = IPythonDisplay(verbose=verbose)
+def parse_nose_args(config, nose_args):
+    """Parse ``nose_args``, and nose's config files, as nose will when it
+    runs, so that combined flags like ``-sv`` and settings from the files
+    count. Returns nose's options, or None if nose will reject the
+    arguments.
+    """
+    # Parsed with plugins of its own: nose keeps the first parser it builds,
+    # and a plugin manager's list of plugins is fixed by its first call, so
+    # neither can be shared with the run that follows
+    plugins = config.plugins
+    if isinstance(plugins, CachedPluginManager):
+        plugins = CachedPluginManager(plugins.factories)
+    else:
+        plugins = type(plugins)()
+    files = config.files
+    if hasattr(files, 'getvalue'):
+        # Reading it would leave nothing for the run itself to read
+        files = StringIO(files.getvalue())
+    probe = Config(env=config.env, files=files, plugins=plugins)
+    saved_stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        options, args = probe._parseArgs(
+            ['ipython-nose'] + list(nose_args), files)
+    except SystemExit:
+        # Bad arguments, which nose will complain about when it runs
+        return None
+    finally:
+        sys.stderr = saved_stderr
+    return options
+
+
+def nose_captures(nose_options):
+    """Return whether nose would capture stdout, and logging, given the
+    options from parse_nose_args.
+    """
+    if nose_options is None:
+        return True, True
+    return (getattr(nose_options, 'capture', True),
+            getattr(nose_options, 'logcapture', True))
 
-    nose_core.TestProgram(
-        argv=argv, suite=tests, addplugins=[plug], exit=False, config=config)
 
+def is_verbose(nose_options):
+    """Whether the options from parse_nose_args ask for more than the
+    default verbosity.
+    """
+    if nose_options is None:
+        return False
+    return (getattr(nose_options, 'verbosity', None) or 1) > 1
+
+
+def nose(line, test_module=None):
+    options, extra_args = parse_magic_line(line)
+    if options.get('clear_fixtures'):
+        _fixture_cache.invalidate()
+    if 'fixture_budget' in options:
+        if options['fixture_budget'] < 0:
+            raise UsageError("--fixture-budget can't be negative")
+        # In megabytes, for the rest of the kernel's life
+        _fixture_cache.budget = int(options['fixture_budget'] * 2 ** 20)
+        _fixture_cache.evict()
+    profile_tests = options.get('profile_tests') or \
+        'profile_output' in options
+    profile = options.get('profile') or profile_tests
+    # Cheap enough to time the phases anyway, but only shown when asked for
+    phases = PhaseTimer()
+    with phases.phase('config'):
+        config = makeNoseConfig(
+            os.environ, reload=options.get('reload_config', False))
+    with phases.phase('discovery'):
+        # The caches decide what looks like a test, which mustn't depend on
+        # this run's selection
+        selector = Selector(config)
+        loader = nose_loader.TestLoader(
+            config=config,
+            selector=SelectingSelector(
+                config, select=options.get('select', ()),
+                deselect=options.get('deselect', ()),
+                shard=options.get('shard')))
+        if test_module is None:
+            test_module = _discovery_cache.test_module(
+                get_ipython().user_ns, selector)
+        elif callable(test_module):
+            test_module = test_module()
+        if options.get('incremental'):
+            test_module, fingerprints, cached_tests, cached_skipped = \
+                _incremental_cache.prune(test_module, selector, (
+                    tuple(options.get('select', ())),
+                    tuple(options.get('deselect', ())),
+                    options.get('shard')))
+        tests = loader.loadTestsFromModule(test_module)
+        history = None
+        if options.get('history') or options.get('last_failed_first'):
+            # The shell the extension was loaded into, if any
+            shell = _cell_index.shell
+            history = ResultHistory(options.get('history') or history_path(
+                shell.user_ns if shell is not None else {}))
+        if options.get('last_failed_first'):
+            tests = order_failed_first(loader, tests, history.last_failed())
+    # The plugin captures output itself, keeping only so much of it and
+    # only for failing tests; nose's capture would keep all of it
+    argv = ['ipython-nose', '--no-skip'] + extra_args + [
+        '--nocapture', '--nologcapture']
+    # In the background, capturing would also swallow what the kernel's
+    # other cells print while the tests run
+    nose_options = parse_nose_args(config, extra_args)
+    capture, capture_logging = nose_captures(nose_options)
+    capture = capture and not options.get('background')
+    capture_logging = capture_logging and not options.get('background')
+    verbose = is_verbose(nose_options)
+    plug = IPythonDisplay(
+        verbose=verbose,
+        live_batch=options.get('live_batch'),
+        live_interval=options.get('live_interval'),
+        page_size=options.get('page_size'),
+        keep_frames=options.get('keep_frames', False),
+        slowest=options.get('slowest'),
+        history=history,
+        max_report_size=options.get('max_report_size'),
+        capture=capture,
+        capture_logging=capture_logging,
+        capture_limit=options.get('capture_limit'),
+        profile_memory=options.get('profile_memory', False),
+        memory_sites=options.get('memory_sites', 0),
+        heaviest=options.get('heaviest'),
+        timeout=options.get('timeout'),
+        live_transport=options.get('live_output'),
+        phases=phases if profile else None,
+        profile_tests=profile_tests,
+        profile_output=(options.get('profile_output')
+                        or default_profile_path) if profile_tests else None)
+    if options.get('incremental'):
+        plug.cached_tests = cached_tests
+        plug.cached_skipped = cached_skipped
+
+    processes = options.get('processes', 1)
+    if processes < 1:
+        raise UsageError('--processes must be at least 1')
+    if options.get('memory_sites') and tracemalloc is None:
+        raise UsageError('--memory-sites needs Python 3.4 or later')
+    if profile_tests and processes > 1:
+        raise UsageError("--profile-tests can't be used with --processes")
+    # The javascript transport is the only one that batches, and the one
+    # used when IPython can't update a display
+    transport = options.get(
+        'live_output', 'javascript' if update_display is None else 'display')
+    if transport == 'display' and update_display is None:
+        raise UsageError(
+            '--live-output display needs an IPython that can update '
+            'displays; use --live-output javascript')
+    if 'live_batch' in options and transport != 'javascript':
+        raise UsageError('--live-batch needs --live-output javascript')
+    # Last, so that a rejected %nose line leaves no report file behind
+    if options.get('report'):
+        plug.report_file = open_report(options['report'])
+
+    def run():
+        with phases.phase('execution'):
+            try:
+                if processes > 1:
+                    run_in_processes(loader, tests, argv, plug, processes)
+                else:
+                    nose_core.TestProgram(
+                        argv=argv + ['--with-ipython-html'], suite=tests,
+                        addplugins=[plug], exit=False, config=config)
+            finally:
+                # Not left capturing the kernel's output, or with the report
+                # unfinished, if the run was interrupted before finalize
+                if plug._capture is not None:
+                    plug._capture.stop()
+                if plug.report_file is not None:
+                    plug.report_file.close()
+        if options.get('incremental'):
+            _incremental_cache.record(fingerprints, plug.outcomes)
+
+    if options.get('background'):
+        return BackgroundRun(plug, run)
+    run()
     return plug
 
 
+class BackgroundRun(object):
+    """A test run going on in a background thread, as returned by
+    ``%nose --background``.
+
+    Display it to see how the run is going, or its results once it's done.
+    """
+
+    def __init__(self, plugin, run):
+        self.plugin = plugin
+        # What stopped the run, if it didn't finish, and its traceback
+        self.exception = None
+        self.error = None
+        plugin.begin()
+        self._thread = threading.Thread(target=self._run, args=(run,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, run):
+        try:
+            run()
+        except BaseException as exception:
+            # Including SystemExit, e.g. from nose rejecting its arguments,
+            # which would otherwise end the thread without a word
+            self.exception = exception
+            self.error = traceback.format_exc()
+
+    @property
+    def result(self):
+        """The IPythonDisplay for the run, which has the results so far."""
+        return self.plugin
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        """Wait for the run to finish, or until ``timeout`` seconds have
+        passed. Returns whether the run is done.
+        """
+        self._thread.join(timeout)
+        return self.done()
+
+    def cancel(self):
+        """Stop the run once the current test is finished."""
+        self.plugin.stop()
+
+    def _status(self):
+        if self.error is not None:
+            return 'Test run failed:\n' + self.error
+        if self.plugin.stopped:
+            state = 'cancelled' if self.done() else 'cancelling'
+        else:
+            state = 'running'
+        return 'Tests %s: %d run so far, %d failed' % (
+            state, self.plugin.num_tests, len(self.plugin.failures))
+
+    def _repr_html_(self):
+        if self.done() and self.error is None:
+            return self.plugin._repr_html_()
+        return '<pre>%s</pre>' % cgi.escape(self._status())
+
+    def _repr_pretty_(self, p, cycle):
+        if self.done() and self.error is None:
+            return self.plugin._repr_pretty_(p, cycle)
+        p.text(self._status())
+
+
+def nose_cell(line, cell):
+    """Run the cell, then only the tests that it defined or redefined."""
+    shell = get_ipython()
+    before = dict(shell.user_ns)
+    result = shell.run_cell(cell)
+    if not getattr(result, 'success', True):
+        return None
+    return nose(line, changed_names_as_a_module(before, shell.user_ns))
+
+
 def load_ipython_extension(ipython):
+    _cell_index.shell = ipython
     magic.register_line_magic(nose)
+    magic.register_cell_magic('nose')(nose_cell)
+
+
+# Results of the %nose runs finished in this process, while it is running a
+# notebook for the batch runner
+_batch_results = None
+
+
+def notebook_code_cells(path):
+    """Return the source of each code cell in the notebook at ``path``,
+    which may be in nbformat 3 or 4.
+    """
+    with io.open(path, encoding='utf-8') as notebook_file:
+        notebook = json.load(notebook_file)
+    if notebook.get('nbformat', 4) >= 4:
+        cells = notebook.get('cells', [])
+    else:
+        cells = [cell for worksheet in notebook.get('worksheets', [])
+                 for cell in worksheet.get('cells', [])]
+    sources = []
+    for cell in cells:
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get('source', cell.get('input', ''))
+        if isinstance(source, list):
+            source = ''.join(source)
+        sources.append(source)
+    return sources
+
+
+def _batch_shell():
+    from IPython.core.interactiveshell import InteractiveShell
+    config = ShellConfig()
+    # Many notebooks at once would fight over the history database
+    config.HistoryManager.hist_file = ':memory:'
+    InteractiveShell.clear_instance()
+    return InteractiveShell.instance(config=config)
+
+
+def run_notebook(path, output_limit=None):
+    """Run the code cells of the notebook at ``path`` in a new IPython
+    shell, in the notebook's directory, as a kernel would. Stops at the
+    first cell that raises.
+
+    Returns a dict of the notebook's ``path``, the ``seconds`` it took, the
+    results of each ``%nose`` run in it (see ``IPythonDisplay.to_dict``) as
+    ``runs``, and an ``error``, which is None unless a cell raised. Then the
+    last of what the cells printed is kept as ``output``.
+
+    Meant for a process of its own: the shell becomes the process's IPython
+    shell, and the standard streams are taken over while the cells run.
+    """
+    global _batch_results
+    result = {'path': path, 'runs': [], 'error': None}
+    started = timer()
+    output = RingBuffer(output_limit or IPythonDisplay.capture_limit)
+    streams = sys.stdout, sys.stderr
+    directory = os.getcwd()
+    _batch_results = []
+    try:
+        cells = notebook_code_cells(path)
+        os.chdir(os.path.dirname(os.path.abspath(path)))
+        sys.stdout = sys.stderr = output
+        shell = _batch_shell()
+        # As a Jupyter kernel is told, e.g. for history_path
+        shell.user_ns['__session__'] = os.path.abspath(path)
+        for number, source in enumerate(cells, 1):
+            cell_result = shell.run_cell(source, store_history=True)
+            if not getattr(cell_result, 'success', True):
+                error = cell_result.error_before_exec or \
+                    cell_result.error_in_exec
+                result['error'] = 'code cell %d raised %s' % (number, ''.join(
+                    traceback.format_exception_only(type(error), error)
+                ).strip())
+                break
+    except Exception:
+        result['error'] = ''.join(traceback.format_exception_only(
+            *sys.exc_info()[:2])).strip()
+    finally:
+        sys.stdout, sys.stderr = streams
+        os.chdir(directory)
+        runs, _batch_results = _batch_results, None
+    result['runs'] = [plug.to_dict() for plug in runs]
+    if result['error'] is not None:
+        result['output'] = output.getvalue()
+    result['seconds'] = timer() - started
+    return result
+
+
+def _run_notebook_worker(path, output_limit, queue):
+    queue.put((path, run_notebook(path, output_limit)))
+
+
+def run_notebooks(paths, processes=None, timeout=None, output_limit=None):
+    """Run each notebook in ``paths`` in a process of its own, at most
+    ``processes`` at a time, yielding run_notebook's results as they
+    finish. A notebook taking over ``timeout`` seconds is stopped.
+    """
+    if not hasattr(os, 'fork'):
+        raise UsageError('running notebooks needs a platform with os.fork')
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        context = multiprocessing
+    processes = processes or multiprocessing.cpu_count()
+    queue = context.Queue()
+    waiting = list(paths)
+    # path -> (worker, time started)
+    running = {}
+
+    def failed(path, error):
+        worker, started = running.pop(path)
+        worker.join()
+        return {'path': path, 'runs': [], 'error': error,
+                'seconds': timer() - started}
+
+    try:
+        while waiting or running:
+            while waiting and len(running) < processes:
+                path = waiting.pop(0)
+                worker = context.Process(
+                    target=_run_notebook_worker,
+                    args=(path, output_limit, queue))
+                worker.start()
+                running[path] = (worker, timer())
+            for path, (worker, started) in list(running.items()):
+                if timeout and timer() - started > timeout:
+                    worker.terminate()
+                    yield failed(
+                        path, 'took longer than %g seconds' % timeout)
+            exited = [path for path, (worker, started) in running.items()
+                      if not worker.is_alive()]
+            try:
+                path, result = queue.get(timeout=0.1)
+            except Empty:
+                # Anything these sent before exiting would have come by now
+                for path in exited:
+                    yield failed(path, 'exited with code %s before '
+                                 'finishing' % running[path][0].exitcode)
+                continue
+            if path in running:
+                # Otherwise it was stopped for taking too long just after
+                running.pop(path)[0].join()
+                yield result
+    finally:
+        for worker, started in running.values():
+            worker.terminate()
+            worker.join()
+
+
+def find_notebooks(paths):
+    """Expand directories in ``paths`` to the notebooks in them."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories[:] = sorted(
+                name for name in subdirectories
+                if name != '.ipynb_checkpoints')
+            for filename in sorted(filenames):
+                if filename.endswith('.ipynb'):
+                    yield os.path.join(directory, filename)
+
+
+def summarize_notebooks(results):
+    """Add up the results of run_notebooks."""
+    summary = {'notebooks': len(results), 'passed': 0, 'failed': 0,
+               'errors': 0, 'tests': 0, 'failures': 0, 'skipped': 0}
+    for result in results:
+        failures = sum(run['failed'] for run in result['runs'])
+        summary['tests'] += sum(run['tests'] for run in result['runs'])
+        summary['failures'] += failures
+        summary['skipped'] += sum(run['skipped'] for run in result['runs'])
+        if result['error'] is not None:
+            summary['errors'] += 1
+        elif failures:
+            summary['failed'] += 1
+        else:
+            summary['passed'] += 1
+    return summary
+
+
+def _notebook_status(result):
+    tests = sum(run['tests'] for run in result['runs'])
+    failures = sum(run['failed'] for run in result['runs'])
+    if result['error'] is not None:
+        status = 'ERROR'
+    elif failures:
+        status = 'FAIL'
+    else:
+        status = 'ok'
+    return '%-5s %s: %d/%d tests passed (%.1fs)' % (
+        status, result['path'], tests - failures, tests, result['seconds'])
+
+
+def main(argv=None):
+    """Run the %nose tests in notebooks from the command line, e.g.::
+
+        python -m ipython_nose --processes 8 notebooks/
+
+    Exits with status 1 if any test failed or any notebook raised.
+    """
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog [options] NOTEBOOK_OR_DIRECTORY...',
+        description='Run the notebooks, each in a fresh IPython shell of '
+                    'its own, and report the results of their %nose runs.')
+    parser.add_option(
+        '-j', '--processes', type='int', default=None,
+        help='notebooks run at once [number of CPUs]')
+    parser.add_option(
+        '--timeout', type='float', default=None,
+        help='stop any notebook still running after this many seconds')
+    parser.add_option(
+        '--json', metavar='PATH',
+        help='also write every result, and the totals, to PATH as JSON')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no notebooks given')
+    if options.processes is not None and options.processes < 1:
+        parser.error('--processes must be at least 1')
+
+    paths = list(find_notebooks(args))
+    started = timer()
+    finished = {}
+    for result in run_notebooks(paths, options.processes, options.timeout):
+        finished[result['path']] = result
+        print(_notebook_status(result))
+        sys.stdout.flush()
+    results = [finished[path] for path in paths]
+    summary = summarize_notebooks(results)
+    summary['seconds'] = timer() - started
+
+    problems = [result for result in results
+                if result['error'] is not None
+                or any(run['failed'] for run in result['runs'])]
+    if problems:
+        print('')
+    for result in problems:
+        print(result['path'])
+        if result['error'] is not None:
+            print('    ' + result['error'])
+        for run in result['runs']:
+            for failure in run['failures']:
+                print('    %s: %s' % (failure['name'], failure['message']))
+    print('')
+    print('%(notebooks)d notebooks: %(passed)d passed, %(failed)d failed, '
+          '%(errors)d errors; %(tests)d tests, %(failures)d failed, '
+          '%(skipped)d skipped in %(seconds).1fs' % summary)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump({'notebooks': results, 'summary': summary}, json_file,
+                      indent=1, sort_keys=True)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    # Run as the importable module, which is the one the notebooks'
+    # %load_ext gets, so that their results are seen
+    from ipython_nose import main
+    sys.exit(main())
@@ -1,6 +1,23 @@
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import types
+from inspect import isfunction
+from xml.etree import ElementTree
 
-from nose.tools import eq_
+from IPython.core.error import UsageError
+from IPython.core.interactiveshell import InteractiveShell
+from nose import core as nose_core
+from nose import loader as nose_loader
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, raises
 
 import ipython_nose
 
@@ -33,10 +50,18 @@ class TestTemplate(object):
 
 
 class FakeTest(object):
+    def id(self):
+        return 'fake'
+
     def shortDescription(self):
         return '<'
 
 
+def make_failure(message):
+    return ipython_nose.FailureRecord.from_exc_info(
+        FakeTest(), get_raised_exception_tuple_with_message(message))
+
+
 class TestIPythonDisplay(object):
     def setup(self):
         self.plugin = ipython_nose.IPythonDisplay()
@@ -143,20 +168,18 @@ class TestIPythonDisplay(object):
         eq_('No tests found.', p.text_called_with)
 
     def test_tracebacks_in_html_escapes_test_name(self):
-        exception_tuple = get_raised_exception_tuple_with_message('>')
         tracebacks = self.plugin._tracebacks(
             [
-                (FakeTest(), exception_tuple),
+                make_failure('>'),
             ],
             self.plugin._tracebacks_template_html
         )
         assert_in('&lt;', tracebacks)
 
     def test_tracebacks_in_html_escapes_traceback(self):
-        exception_tuple = get_raised_exception_tuple_with_message('>')
         tracebacks = self.plugin._tracebacks(
             [
-                (FakeTest(), exception_tuple),
+                make_failure('>'),
             ],
             self.plugin._tracebacks_template_html
 
@@ -164,20 +187,18 @@ class TestIPythonDisplay(object):
         assert_in('&gt;', tracebacks)
 
     def test_tracebacks_in_text_does_not_escape_test_name(self):
-        exception_tuple = get_raised_exception_tuple_with_message('>')
         tracebacks = self.plugin._tracebacks(
             [
-                (FakeTest(), exception_tuple),
+                make_failure('>'),
             ],
             self.plugin._tracebacks_template_text
         )
         assert_in('>', tracebacks)
 
     def test_tracebacks_in_text_does_not_escape_traceback(self):
-        exception_tuple = get_raised_exception_tuple_with_message('>')
         tracebacks = self.plugin._tracebacks(
             [
-                (FakeTest(), exception_tuple),
+                make_failure('>'),
             ],
             self.plugin._tracebacks_template_text
 
@@ -190,16 +211,1971 @@ class TestIPythonDisplay(object):
         linkified = self.plugin.linkify_html_traceback(
             '&lt;' + frame_name + '&gt;')
         expected_link = (
-            '&lt;<a href="#' +
+            '&lt;<a class="noseframe" href="#' +
             frame_name +
-            '">' +
-            frame_name +
-            '</a>')
+            '" data-cell="' +
+            frame_number +
+            '"')
         assert expected_link in linkified, "\n%s\nnot in\n%s" % (
             expected_link, linkified)
-        expected_selector = (
-            '$("div.prompt.input_prompt:contains([' +
-            frame_number +
-            '])")')
-        assert expected_selector in linkified, "\n%s\nnot in\n%s" % (
-            expected_selector, linkified)
+        assert_in('>' + frame_name + '</a>&gt;', linkified)
+
+    def test_linkify_html_traceback_links_to_line(self):
+        frame_name = 'ipython-input-1-0123456789ab'
+        linkified = self.plugin.linkify_html_traceback(
+            '  File "&lt;' + frame_name + '&gt;", line 2, in test_it')
+        assert_in('href="#' + frame_name + '-2"', linkified)
+        assert_in('data-line="2"', linkified)
+
+    def test_frame_links_script_is_shown_once(self):
+        self.plugin.num_tests = 2
+        self.plugin.failures = [make_failure('a'), make_failure('b')]
+        eq_(1, self.plugin._repr_html_().count('a.noseframe'))
+
+
+class TestCellSourceIndex(object):
+    def setup(self):
+        # A real shell, with its history kept in memory
+        self.shell = ipython_nose._batch_shell()
+        self.index = ipython_nose.CellSourceIndex(self.shell)
+
+    def teardown(self):
+        InteractiveShell.clear_instance()
+
+    def run(self, source):
+        """Run ``source`` as a cell, and return the name its first function
+        was compiled under.
+        """
+        self.shell.run_cell(source, store_history=True)
+        function = [value for value in self.shell.user_ns.values()
+                    if isfunction(value)][-1]
+        return function.__code__.co_filename.strip('<>')
+
+    def test_lookup(self):
+        self.shell.run_cell('x = 1\n', store_history=True)
+        name = self.run('def test_it():\n    assert x == 2\n\n')
+        eq_((2, 'def test_it():\n    assert x == 2'), self.index.lookup(name))
+        eq_('assert x == 2', self.index.line(name, 2))
+        eq_(None, self.index.line(name, 3))
+
+    def test_lookup_after_magic(self):
+        name = self.run('%autocall 0\ndef test_it():\n    assert False')
+        eq_('assert False', self.index.line(name, 3))
+
+    def test_unknown_cell(self):
+        eq_(None, self.index.lookup('ipython-input-9-0123456789ab'))
+        eq_(None, self.index.lookup('anything'))
+        eq_(None, ipython_nose.CellSourceIndex().lookup(
+            'ipython-input-1-0123456789ab'))
+
+    def test_link_has_source_line_as_title(self):
+        name = self.run('def test_it():\n    assert False\n')
+        ipython_nose._cell_index, index = self.index, ipython_nose._cell_index
+        try:
+            html = ipython_nose.html_traceback(
+                '  File "<%s>", line 2, in test_it' % name)
+        finally:
+            ipython_nose._cell_index = index
+        assert_in('title="assert False"', html)
+
+
+class TestParseMagicLine(object):
+    def test_nose_args_are_passed_through(self):
+        options, nose_args = ipython_nose.parse_magic_line('-v -x')
+        eq_({}, options)
+        eq_(['-v', '-x'], nose_args)
+
+    def test_option_with_separate_value(self):
+        options, nose_args = ipython_nose.parse_magic_line(
+            '--live-batch 50 -v')
+        eq_({'live_batch': 50}, options)
+        eq_(['-v'], nose_args)
+
+    def test_option_with_equals_value(self):
+        options, nose_args = ipython_nose.parse_magic_line(
+            '--live-interval=0.5')
+        eq_({'live_interval': 0.5}, options)
+        eq_([], nose_args)
+
+    def test_fixture_options(self):
+        options, nose_args = ipython_nose.parse_magic_line(
+            '--clear-fixtures --fixture-budget 512')
+        eq_({'clear_fixtures': True, 'fixture_budget': 512.0}, options)
+
+    def test_live_output_option(self):
+        options, nose_args = ipython_nose.parse_magic_line(
+            '--live-output javascript')
+        eq_({'live_output': 'javascript'}, options)
+
+    @raises(UsageError)
+    def test_live_output_option_with_bad_value(self):
+        ipython_nose.parse_magic_line('--live-output=carrier-pigeon')
+
+    @raises(UsageError)
+    def test_option_missing_value(self):
+        ipython_nose.parse_magic_line('--live-batch')
+
+    @raises(UsageError)
+    def test_option_with_bad_value(self):
+        ipython_nose.parse_magic_line('--live-batch=lots')
+
+
+class RecordingStream(object):
+    def __init__(self, tty):
+        self.tty = tty
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+
+    def isatty(self):
+        return self.tty
+
+
+class StreamOwner(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+
+class TestConsoleLiveOutput(object):
+    def make_output(self, tty, flush_interval):
+        self.stream = RecordingStream(tty)
+        return ipython_nose.ConsoleLiveOutput(
+            StreamOwner(self.stream), flush_interval=flush_interval)
+
+    def test_chunks_characters_when_not_a_tty(self):
+        output = self.make_output(tty=False, flush_interval=60)
+        for chars in '..F.S.E':
+            output.write_chars(chars)
+        eq_([], self.stream.writes)
+        output.finalize()
+        eq_(['..F.S.E', '\n'], self.stream.writes)
+
+    def test_flushes_once_interval_has_passed(self):
+        output = self.make_output(tty=False, flush_interval=0)
+        output.write_chars('.')
+        output.write_chars('F')
+        eq_(['.', 'F'], self.stream.writes)
+
+    def test_redraws_progress_line_on_a_tty(self):
+        output = self.make_output(tty=True, flush_interval=60)
+        for chars in '..F.S.E':
+            output.write_chars(chars)
+        eq_([], self.stream.writes)
+        output.finalize()
+        line = self.stream.writes[0]
+        assert line.startswith('\r\x1b[K')
+        assert_in('4 passed, 1 failed, 1 errors, 1 skipped (', line)
+        assert_in('tests/s)', line)
+        eq_('\n', self.stream.writes[-1])
+
+    def test_verbose_lines_go_above_progress_line(self):
+        output = self.make_output(tty=True, flush_interval=0)
+        output.write_line('test_it ... fail')
+        assert_in('test_it ... fail\n0 passed, 1 failed',
+                  self.stream.writes[0])
+
+
+class TestNotebookLiveOutput(object):
+    def setup(self):
+        self.published = []
+        self.original_publish = ipython_nose.displaypub.publish_display_data
+        ipython_nose.displaypub.publish_display_data = (
+            lambda source, data: self.published.append(data))
+
+    def teardown(self):
+        ipython_nose.displaypub.publish_display_data = self.original_publish
+
+    def test_publishes_every_result_by_default(self):
+        live_output = ipython_nose.NotebookLiveOutput()
+        del self.published[:]
+        live_output.write_chars('.')
+        live_output.write_line('test_foo ... pass')
+        eq_(2, len(self.published))
+
+    def test_batches_results(self):
+        live_output = ipython_nose.NotebookLiveOutput(flush_every=3)
+        del self.published[:]
+        live_output.write_chars('.')
+        live_output.write_chars('F')
+        eq_(0, len(self.published))
+        live_output.write_line('<test>')
+        eq_(1, len(self.published))
+        script = self.published[0]['application/javascript']
+        assert_in('<span>.</span><span>F</span>', script)
+        assert_in('&lt;test&gt;', script)
+
+    def test_finalize_flushes_pending_results(self):
+        live_output = ipython_nose.NotebookLiveOutput(
+            flush_every=None, flush_interval=3600)
+        del self.published[:]
+        live_output.write_chars('.')
+        eq_(0, len(self.published))
+        live_output.finalize()
+        assert_in('<span>.</span>',
+                  self.published[0]['application/javascript'])
+        assert_in('delete document.',
+                  self.published[-1]['application/javascript'])
+
+
+class TestDisplayLiveOutput(object):
+    def setup(self):
+        self.shown = []
+        self.updates = []
+        self.originals = ipython_nose.display, ipython_nose.update_display
+        ipython_nose.display = (
+            lambda data, raw, display_id: self.shown.append(
+                (display_id, data)))
+        ipython_nose.update_display = (
+            lambda data, raw, display_id: self.updates.append(
+                (display_id, data)))
+
+    def teardown(self):
+        ipython_nose.display, ipython_nose.update_display = self.originals
+
+    def test_shows_one_display_and_updates_it(self):
+        live_output = ipython_nose.DisplayLiveOutput(flush_interval=0)
+        live_output.write_chars('.')
+        live_output.write_chars('F')
+        live_output.finalize()
+        eq_(1, len(self.shown))
+        eq_(3, len(self.updates))
+        eq_(set([live_output.display_id]),
+            set(display_id for display_id, data in self.shown + self.updates))
+        html = self.updates[-1][1]['text/html']
+        assert_in('1 passed, 1 failed, 0 errors, 0 skipped', html)
+        assert_in('<pre>.F</pre>', html)
+
+    def test_updates_are_rate_limited(self):
+        live_output = ipython_nose.DisplayLiveOutput(flush_interval=3600)
+        for _ in range(100):
+            live_output.write_chars('.')
+        eq_(0, len(self.updates))
+        live_output.finalize()
+        eq_(1, len(self.updates))
+        assert_in('100 passed', self.updates[0][1]['text/plain'])
+
+    def test_updates_stay_the_same_size(self):
+        live_output = ipython_nose.DisplayLiveOutput(flush_interval=0)
+        for number in range(1000):
+            live_output.write_line('test_%d ... pass' % number)
+        # Only the counts and the rate change length
+        sizes = [len(data['text/plain']) for _, data in self.updates[10:]]
+        assert max(sizes) - min(sizes) < 20
+        text = self.updates[-1][1]['text/plain']
+        assert_in('1000 passed', text)
+        assert_in('test_999 ... pass', text)
+        assert_not_in('test_994 ', text)
+
+    @raises(UsageError)
+    def test_display_transport_needs_update_display(self):
+        ipython_nose.update_display = None
+        run_magic('--live-output display', make_sample_module())
+
+    @raises(UsageError)
+    def test_live_batch_needs_javascript_transport(self):
+        run_magic('--live-batch 10', make_sample_module())
+
+    def test_live_batch_without_update_display(self):
+        # Where the javascript transport is the default anyway
+        ipython_nose.update_display = None
+        plug, output = run_magic('--live-batch 10', make_sample_module())
+        eq_(4, plug.num_tests)
+        eq_('.FSE', output.splitlines()[-1])
+
+    def test_escapes_lines(self):
+        live_output = ipython_nose.DisplayLiveOutput(flush_interval=0)
+        live_output.write_line('<test> ... fail')
+        assert_in('&lt;test&gt; ... fail', self.updates[-1][1]['text/html'])
+
+
+def build_sample_module(name='test_module', **attrs):
+    """Make a module to run nose on, holding ``attrs``. The functions
+    making them are named so that the outer test run doesn't collect them.
+    """
+    sample_module = types.ModuleType(name)
+    sample_module.__dict__.update(attrs)
+    return sample_module
+
+
+def run_magic(line, test_module):
+    """Run ``%nose line`` on ``test_module``, catching what it writes to
+    the console. Returns its result and what it wrote.
+    """
+    stderr = sys.stderr
+    sys.stderr = ipython_nose.StringIO()
+    try:
+        return ipython_nose.nose(line, test_module), sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+
+
+def make_sample_module():
+    # Defined inside a function so that the outer test run doesn't
+    # collect them.
+    def test_passes():
+        pass
+
+    def test_fails():
+        assert False, 'expected failure'
+
+    def test_skips():
+        raise SkipTest()
+
+    def test_errors():
+        raise Exception('expected error')
+
+    return build_sample_module(
+        test_passes=test_passes,
+        test_fails=test_fails,
+        test_skips=test_skips,
+        test_errors=test_errors)
+
+
+class ConsoleDisplay(ipython_nose.IPythonDisplay):
+    """IPythonDisplay that never looks for a notebook, and keeps its live
+    output out of the outer test run's.
+    """
+
+    def begin(self):
+        self.live_output = ipython_nose.ConsoleLiveOutput(
+            StreamOwner(ipython_nose.StringIO()))
+
+
+def make_loader():
+    config = ipython_nose.makeNoseConfig({})
+    return nose_loader.TestLoader(config=config)
+
+
+class TestSplitSuite(object):
+    def test_workers_share_all_tests(self):
+        loader = make_loader()
+        names = []
+        for index in range(3):
+            suite = loader.loadTestsFromModule(make_sample_module())
+            share = ipython_nose.split_suite(loader, suite, index, 3)
+            names.extend(test.id() for test in share)
+        eq_(4, len(names))
+        eq_(4, len(set(names)))
+
+
+class TestRunInProcesses(object):
+    def test_results_are_collected_from_workers(self):
+        loader = make_loader()
+        suite = loader.loadTestsFromModule(make_sample_module())
+        plug = ConsoleDisplay()
+        ipython_nose.run_in_processes(
+            loader, suite, ['ipython-nose', '--no-skip'], plug, 2)
+        eq_(4, plug.num_tests)
+        eq_(1, plug.skipped)
+        eq_(2, len(plug.failures))
+        messages = sorted(failure.message for failure in plug.failures)
+        eq_(['AssertionError: expected failure', 'Exception: expected error'],
+            messages)
+
+
+def run_cell(namespace, source):
+    exec(source, namespace)
+
+
+class TestFingerprint(object):
+    def setup(self):
+        self.namespace = {'__name__': '__notebook__'}
+
+    def fingerprint_after(self, source, name='test_it'):
+        run_cell(self.namespace, source)
+        return ipython_nose.fingerprint(self.namespace[name])
+
+    def test_rerunning_same_code_keeps_fingerprint(self):
+        source = 'def test_it():\n    assert 1 + 1 == 2\n'
+        eq_(self.fingerprint_after(source), self.fingerprint_after(source))
+
+    def test_editing_code_changes_fingerprint(self):
+        before = self.fingerprint_after(
+            'def test_it(x=1):\n    assert x == 1\n')
+        after = self.fingerprint_after(
+            'def test_it(x=1):\n    assert x == 2\n')
+        assert before != after
+
+    def test_editing_called_function_changes_fingerprint(self):
+        run_cell(self.namespace, 'def helper():\n    return 1\n')
+        before = self.fingerprint_after('def test_it():\n    helper()\n')
+        run_cell(self.namespace, 'def helper():\n    return 2\n')
+        after = ipython_nose.fingerprint(self.namespace['test_it'])
+        assert before != after
+
+    def test_rebinding_global_changes_fingerprint(self):
+        run_cell(self.namespace, 'EXPECTED = 1\n')
+        before = self.fingerprint_after(
+            'def test_it():\n    assert EXPECTED\n')
+        run_cell(self.namespace, 'EXPECTED = 2\n')
+        after = ipython_nose.fingerprint(self.namespace['test_it'])
+        assert before != after
+
+    def test_editing_method_changes_class_fingerprint(self):
+        before = self.fingerprint_after(
+            'class TestIt(object):\n    def test_a(self):\n        return 1\n',
+            'TestIt')
+        after = self.fingerprint_after(
+            'class TestIt(object):\n    def test_a(self):\n        return 2\n',
+            'TestIt')
+        assert before != after
+
+    def test_rerunning_same_class_keeps_fingerprint(self):
+        for source in (
+                'class TestIt(object):\n    def test_a(self):\n        pass\n',
+                'class TestIt(object):\n    __slots__ = ("value",)\n'):
+            eq_(self.fingerprint_after(source, 'TestIt'),
+                self.fingerprint_after(source, 'TestIt'))
+
+    def test_editing_base_class_changes_subclass_fingerprint(self):
+        run_cell(
+            self.namespace,
+            'class Base(object):\n    def test_a(self):\n        return 1\n')
+        before = self.fingerprint_after(
+            'class TestIt(Base):\n    pass\n', 'TestIt')
+        run_cell(
+            self.namespace,
+            'class Base(object):\n    def test_a(self):\n        return 2\n')
+        after = self.fingerprint_after(
+            'class TestIt(Base):\n    pass\n', 'TestIt')
+        assert before != after
+
+    def test_mutating_global_changes_fingerprint(self):
+        run_cell(self.namespace, 'CASES = [1, 2]\n')
+        before = self.fingerprint_after(
+            'def test_it():\n    assert CASES\n')
+        self.namespace['CASES'].append(3)
+        after = ipython_nose.fingerprint(self.namespace['test_it'])
+        assert before != after
+
+    def test_unpicklable_global_always_changes_fingerprint(self):
+        run_cell(self.namespace, 'import threading\nLOCK = threading.Lock()\n')
+        before = self.fingerprint_after(
+            'def test_it():\n    assert LOCK\n')
+        after = ipython_nose.fingerprint(self.namespace['test_it'])
+        assert before != after
+
+    def test_unpicklable_global_by_identity(self):
+        run_cell(self.namespace, 'import threading\nLOCK = threading.Lock()\n')
+        run_cell(self.namespace, 'def test_it():\n    assert LOCK\n')
+        test_it = self.namespace['test_it']
+        before = ipython_nose.fingerprint(test_it, by_identity=True)
+        eq_(before, ipython_nose.fingerprint(test_it, by_identity=True))
+        run_cell(self.namespace, 'LOCK = threading.Lock()\n')
+        assert before != ipython_nose.fingerprint(test_it, by_identity=True)
+
+    def test_recursive_function_keeps_fingerprint(self):
+        source = 'def test_it(n=1):\n    return n and test_it(n - 1)\n'
+        eq_(self.fingerprint_after(source), self.fingerprint_after(source))
+
+
+class TestIncrementalCache(object):
+    def setup(self):
+        self.cache = ipython_nose.IncrementalCache()
+        self.selector = make_loader().selector
+        self.test_module = make_sample_module()
+
+    def first_run(self):
+        pruned, fingerprints, cached_tests, cached_skipped = \
+            self.cache.prune(self.test_module, self.selector)
+        self.cache.record(fingerprints, {
+            'test_module.test_passes': 'pass',
+            'test_module.test_fails': 'fail',
+            'test_module.test_skips': 'skip',
+            'test_module.test_errors': 'error',
+        })
+
+    def test_first_run_keeps_everything(self):
+        pruned, fingerprints, cached_tests, cached_skipped = \
+            self.cache.prune(self.test_module, self.selector)
+        eq_(4, len(fingerprints))
+        eq_(0, cached_tests)
+        assert hasattr(pruned, 'test_passes')
+
+    def test_unchanged_passing_tests_are_pruned(self):
+        self.first_run()
+        pruned, fingerprints, cached_tests, cached_skipped = \
+            self.cache.prune(self.test_module, self.selector)
+        eq_(['test_errors', 'test_fails'], sorted(fingerprints))
+        eq_(2, cached_tests)
+        eq_(1, cached_skipped)
+        assert not hasattr(pruned, 'test_passes')
+        assert hasattr(self.test_module, 'test_passes')
+
+    def test_changed_tests_are_kept(self):
+        self.first_run()
+        def test_passes():
+            assert True is not False
+        self.test_module.test_passes = test_passes
+        pruned, fingerprints, cached_tests, cached_skipped = \
+            self.cache.prune(self.test_module, self.selector)
+        assert 'test_passes' in fingerprints
+        eq_(1, cached_tests)
+
+    def test_results_are_kept_per_selection(self):
+        self.first_run()
+        pruned, fingerprints, cached_tests, cached_skipped = \
+            self.cache.prune(self.test_module, self.selector,
+                             ((), (), (1, 2)))
+        eq_(4, len(fingerprints))
+        eq_(0, cached_tests)
+
+
+class CallLog(list):
+    """Pickles the same however many calls it has logged, so that logging
+    them doesn't count as changing the fixture that does it.
+    """
+
+    def __reduce__(self):
+        return (CallLog, ())
+
+
+class TestFixtureCache(object):
+    def setup(self):
+        self.cache = ipython_nose.FixtureCache()
+        self.namespace = {'__name__': '__notebook__', 'calls': CallLog()}
+        run_cell(self.namespace, '\n'.join([
+            'def load(size=10):',
+            '    calls.append(size)',
+            '    return list(range(size))',
+        ]))
+
+    def load(self, *args):
+        return self.cache.get(self.namespace['load'], args)
+
+    def test_result_is_reused(self):
+        first = self.load()
+        assert self.load() is first
+        eq_([10], self.namespace['calls'])
+        eq_((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_arguments_are_part_of_the_key(self):
+        self.load(1)
+        self.load(2)
+        self.load(1)
+        eq_([1, 2], self.namespace['calls'])
+
+    def test_fixture_using_a_class_and_a_lock_is_reused(self):
+        run_cell(self.namespace, '\n'.join([
+            'import threading',
+            'LOCK = threading.Lock()',
+            'class Dataset(object):',
+            '    def __init__(self, size):',
+            '        self.rows = list(range(size))',
+            'def load(size=10):',
+            '    calls.append(size)',
+            '    with LOCK:',
+            '        return Dataset(size)',
+        ]))
+        first = self.load()
+        assert self.load() is first
+        eq_((1, 1), (self.cache.hits, self.cache.misses))
+        run_cell(self.namespace, 'LOCK = threading.Lock()\n')
+        assert self.load() is not first
+        eq_([10, 10], self.namespace['calls'])
+
+    def test_unhashable_arguments_run_every_time(self):
+        self.cache.get(len, ([1],))
+        self.cache.get(len, ([1],))
+        eq_(0, len(self.cache.entries))
+        eq_(2, self.cache.misses)
+
+    def test_redefined_fixture_runs_again_and_replaces_old_result(self):
+        self.load()
+        run_cell(self.namespace, '\n'.join([
+            'def load(size=10):',
+            '    calls.append(-size)',
+            '    return list(range(size))',
+        ]))
+        self.load()
+        eq_([10, -10], self.namespace['calls'])
+        eq_(1, len(self.cache.entries))
+
+    def test_invalidate(self):
+        self.load()
+        self.cache.invalidate(self.namespace['load'])
+        self.load()
+        self.cache.invalidate()
+        eq_(0, self.cache.size)
+        self.load()
+        eq_([10, 10, 10], self.namespace['calls'])
+
+    def test_least_recently_used_results_are_evicted(self):
+        self.cache.budget = ipython_nose.deep_size(list(range(10))) * 2
+        self.load(10)
+        self.load(9)
+        self.load(10)
+        self.load(8)
+        eq_([8, 10], sorted(key[2][0] for key in self.cache.entries))
+        eq_([10, 8], [key[2][0] for key in self.cache.order])
+        assert self.cache.size <= self.cache.budget
+
+    def test_result_bigger_than_budget_is_not_kept(self):
+        self.cache.budget = 1
+        eq_(list(range(10)), self.load())
+        eq_(0, len(self.cache.entries))
+        eq_(0, self.cache.size)
+
+    def test_decorator(self):
+        calls = CallLog()
+
+        @ipython_nose.cached_fixture
+        def load_dataset():
+            calls.append(1)
+            return object()
+
+        try:
+            eq_('load_dataset', load_dataset.__name__)
+            assert load_dataset() is load_dataset()
+            load_dataset.invalidate()
+            load_dataset()
+            eq_(2, len(calls))
+        finally:
+            load_dataset.invalidate()
+
+    def test_deep_size_follows_containers_and_attributes(self):
+        holder = FakeTest()
+        holder.data = ['x' * 1000]
+        assert ipython_nose.deep_size(holder) > 1000
+        assert ipython_nose.deep_size({'key': holder}) > 1000
+        shared = 'y' * 1000
+        assert ipython_nose.deep_size([shared, shared]) < 2000
+
+
+class TestChangedNamesAsAModule(object):
+    def test_keeps_only_added_and_rebound_names(self):
+        unchanged = object()
+        before = {'test_same': unchanged, 'test_rebound': object()}
+        after = dict(before, test_rebound=object(), test_new=object())
+        test_module = ipython_nose.changed_names_as_a_module(before, after)
+        assert not hasattr(test_module, 'test_same')
+        assert test_module.test_rebound is after['test_rebound']
+        assert test_module.test_new is after['test_new']
+
+    def test_is_named_after_namespace(self):
+        test_module = ipython_nose.changed_names_as_a_module(
+            {}, {'__name__': '__main__'})
+        eq_('__main__', test_module.__name__)
+
+    def test_keeps_module_fixtures(self):
+        namespace = {'setup_module': object(), 'teardown': object()}
+        test_module = ipython_nose.changed_names_as_a_module(
+            namespace, namespace)
+        assert hasattr(test_module, 'setup_module')
+        assert hasattr(test_module, 'teardown')
+
+
+class TestPaging(object):
+    def setup(self):
+        self.plugin = ipython_nose.IPythonDisplay(page_size=2)
+        self.plugin.num_tests = 5
+        for message in ['first', 'second', 'third', 'fourth', 'fifth']:
+            self.plugin.failures.append(make_failure(message))
+
+    def test_report_shows_first_page_only(self):
+        html = self.plugin._repr_html_()
+        assert_in('first', html)
+        assert_in('second', html)
+        assert_not_in('third', html)
+        assert_in('Showing failures 1-2 of 5', html)
+        assert_in('.page(2)', html)
+
+    def test_later_page(self):
+        html = self.plugin.page(2)._repr_html_()
+        assert_not_in('second', html)
+        assert_in('third', html)
+        assert_in('fourth', html)
+        assert_in('.page(3)', html)
+
+    def test_last_page_has_no_next_page(self):
+        html = self.plugin.page(3)._repr_html_()
+        assert_in('fifth', html)
+        assert_not_in('Showing failures', html)
+
+    def test_page_size_0_shows_everything(self):
+        self.plugin.page_size = 0
+        html = self.plugin._repr_html_()
+        assert_in('fifth', html)
+        assert_not_in('Showing failures', html)
+
+    def test_negative_pages_count_back_from_the_last(self):
+        eq_(3, self.plugin.page(-1).number)
+        eq_(1, self.plugin.page(-3).number)
+        html = self.plugin.page(-1)._repr_html_()
+        assert_in('fifth', html)
+        assert_not_in('fourth', html)
+
+    @raises(ValueError)
+    def test_page_before_the_first(self):
+        self.plugin.page(-4)
+
+    @raises(ValueError)
+    def test_page_0(self):
+        self.plugin.page(0)
+
+    def test_page_with_its_own_size(self):
+        html = self.plugin.page(2, page_size=3)._repr_html_()
+        assert_in('fourth', html)
+        assert_in('fifth', html)
+        assert_not_in('third', html)
+        eq_(2, self.plugin.page(-1, page_size=3).number)
+
+    @raises(ValueError)
+    def test_negative_page_size(self):
+        self.plugin.page(1, page_size=-1)
+
+    @raises(UsageError)
+    def test_negative_page_size_option(self):
+        ipython_nose.parse_magic_line('--page-size -1')
+
+    def test_report_uses_formatted_tracebacks(self):
+        self.plugin.failures[0].formatted_traceback = 'recorded traceback'
+        assert_in('recorded traceback', self.plugin._repr_html_())
+
+
+class TestBoundedReport(object):
+    def setup(self):
+        self.plugin = ipython_nose.IPythonDisplay(page_size=0)
+        self.plugin.num_tests = 50
+        for number in range(50):
+            self.plugin.failures.append(make_failure('failure %d' % number))
+
+    def test_bounded_output_leaves_out_what_does_not_fit(self):
+        output = ipython_nose.BoundedOutput(10)
+        eq_(True, output.write('12345'))
+        eq_(False, output.write('123456'))
+        eq_(False, output.write('1'))
+        eq_(True, output.truncated)
+        eq_('12345', output.getvalue())
+
+    def test_no_limit(self):
+        output = ipython_nose.BoundedOutput(0)
+        output.write('x' * 10000)
+        eq_(None, output.room())
+        eq_(False, output.truncated)
+
+    def test_clip_keeps_start_and_end(self):
+        clipped = ipython_nose.clip('start' + 'x' * 1000 + 'end', 100)
+        assert clipped.startswith('start')
+        assert clipped.endswith('end')
+        assert_in('characters cut', clipped)
+        assert len(clipped) <= 100
+
+    def test_html_report_is_cut_short_with_marker(self):
+        self.plugin.max_report_size = 20000
+        html = self.plugin._repr_html_()
+        assert len(html) < 21000
+        assert_in('failure 0', html)
+        assert_not_in('failure 49', html)
+        assert_in('under 20000 characters', html)
+
+    def test_marker_names_the_page_showing_the_next_failure(self):
+        self.plugin.max_report_size = 20000
+        html = self.plugin._repr_html_()
+        number = int(
+            re.search(r'\.page\((\d+), page_size=1\)', html).group(1))
+        assert_not_in('failure %d\n' % (number - 1), html)
+        next_failure = self.plugin.page(number, page_size=1)._repr_html_()
+        assert_in('failure %d\n' % (number - 1), next_failure)
+        assert_in('.page(%d, page_size=1)' % (number + 1), next_failure)
+
+    def test_text_report_is_cut_short_with_marker(self):
+        class MockPretty(object):
+            def text(self, text):
+                self.texts = text
+        self.plugin.max_report_size = 5000
+        p = MockPretty()
+        self.plugin._repr_pretty_(p=p, cycle=False)
+        assert_in('of the 50 failures here', p.texts)
+
+    def test_huge_traceback_is_clipped_not_dropped(self):
+        self.plugin.failures = [make_failure('x' * 50000)]
+        self.plugin.max_report_size = 20000
+        html = self.plugin._repr_html_()
+        assert_in('characters cut', html)
+        assert_in('nosefailedfunc', html)
+
+    def test_only_frame_lines_are_linked(self):
+        name = 'ipython-input-3-0123456789ab'
+        html = ipython_nose.html_traceback(
+            '  File "<%s>", line 2, in test\nValueError: %s' % (name, name))
+        lines = html.split('\n')
+        assert_in('href="#%s-2"' % name, lines[0])
+        eq_('ValueError: %s' % name, lines[-1])
+
+
+class TestFailureRecord(object):
+    def test_records_failure_details(self):
+        record = make_failure('oops')
+        eq_('fake', record.test_id)
+        eq_('<', record.name)
+        eq_('Exception', record.exc_type)
+        eq_('Exception: oops', record.message)
+        assert_in('Traceback', record.formatted_traceback)
+        assert_in('oops', record.formatted_traceback)
+
+    def test_does_not_keep_frames_by_default(self):
+        eq_(None, make_failure('oops').exc_info)
+
+    def test_keeps_frames_when_asked(self):
+        exc_info = get_raised_exception_tuple_with_message('oops')
+        record = ipython_nose.FailureRecord.from_exc_info(
+            FakeTest(), exc_info, keep_exc_info=True)
+        assert record.exc_info is exc_info
+
+    def test_pickles_without_frames(self):
+        exc_info = get_raised_exception_tuple_with_message('oops')
+        record = ipython_nose.FailureRecord.from_exc_info(
+            FakeTest(), exc_info, keep_exc_info=True)
+        unpickled = pickle.loads(pickle.dumps(record))
+        eq_(record.formatted_traceback, unpickled.formatted_traceback)
+        eq_(None, unpickled.exc_info)
+
+
+def make_printing_sample_module():
+    def test_prints_and_passes():
+        for _ in range(1000):
+            print('passing noise')
+
+    def test_prints_and_fails():
+        for number in range(1000):
+            print('line %d' % number)
+        sys.stderr.write('to stderr\n')
+        logging.getLogger('notebook').warning('logged')
+        assert False
+
+    return build_sample_module(
+        test_prints_and_passes=test_prints_and_passes,
+        test_prints_and_fails=test_prints_and_fails)
+
+
+class TestOutputCapture(object):
+    def test_ring_buffer_keeps_the_end(self):
+        buffer = ipython_nose.RingBuffer(10)
+        buffer.write('abcdef')
+        buffer.write('ghijkl')
+        eq_(10, buffer.size)
+        eq_('[... 2 characters dropped ...]\ncdefghijkl', buffer.getvalue())
+        buffer.write('x' * 25)
+        eq_('[... 27 characters dropped ...]\n' + 'x' * 10,
+            buffer.getvalue())
+
+    def test_ring_buffer_without_limit(self):
+        buffer = ipython_nose.RingBuffer(0)
+        buffer.write('abcdef')
+        buffer.write('ghijkl')
+        eq_('abcdefghijkl', buffer.getvalue())
+
+    def test_capture_restores_streams(self):
+        stdout, stderr = sys.stdout, sys.stderr
+        capture = ipython_nose.OutputCapture(100)
+        capture.start()
+        print('hello')
+        eq_([('stdout', 'hello\n')], capture.captured())
+        capture.stop()
+        assert sys.stdout is stdout and sys.stderr is stderr
+        eq_([], capture.captured())
+
+    def test_only_failing_tests_output_is_kept(self):
+        plug = ConsoleDisplay(capture=True, capture_logging=True,
+                              capture_limit=200)
+        run_nose(plug, make_printing_sample_module(),
+                 '--nocapture', '--nologcapture')()
+        eq_(1, len(plug.failures))
+        captured = dict(plug.failures[0].captured)
+        eq_(['logging', 'stderr', 'stdout'], sorted(captured))
+        assert captured['stdout'].endswith('line 999\n')
+        assert_in('characters dropped', captured['stdout'])
+        eq_('notebook: WARNING: logged\n', captured['logging'])
+        html = plug._repr_html_()
+        assert_in('captured stdout:', html)
+        assert_not_in('passing noise', html)
+
+    def test_fixture_output_is_captured_separately(self):
+        def test_a():
+            print('output of test_a')
+
+        def teardown_module():
+            print('output of teardown')
+            raise ValueError('teardown failed')
+
+        test_module = types.ModuleType('test_module')
+        test_module.test_a = test_a
+        test_module.teardown_module = teardown_module
+        plug = ConsoleDisplay(capture=True)
+        run_nose(plug, test_module, '--nocapture', '--nologcapture')()
+        assert plug.failures
+        for failure in plug.failures:
+            output = ''.join(text for stream, text in failure.captured)
+            assert_in('output of teardown', output)
+            assert_not_in('output of test_a', output)
+        assert not plug._capture.running
+
+    def test_no_capture_flags_are_parsed_as_nose_does(self):
+        def captures(*nose_args):
+            return ipython_nose.nose_captures(ipython_nose.parse_nose_args(
+                make_loader().config, nose_args))
+        eq_((True, True), captures('-v'))
+        eq_((False, True), captures('-sv'))
+        eq_((True, False), captures('--nologcapture'))
+        stderr = sys.stderr
+        sys.stderr = ipython_nose.StringIO()
+        try:
+            eq_((True, True), captures('--no-such-option'))
+            eq_('', sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+    def test_no_capture_in_config_file_is_read_without_using_it_up(self):
+        config = ipython_nose.makeNoseConfig({})
+        config.files = ipython_nose.StringIO('[nosetests]\nnocapture=1\n')
+        eq_((False, True), ipython_nose.nose_captures(
+            ipython_nose.parse_nose_args(config, [])))
+        options, args = config._parseArgs(['ipython-nose'], config.files)
+        eq_(False, options.capture)
+
+    def test_captured_output_survives_pickling(self):
+        failure = make_failure('oops')
+        failure.captured = [('stdout', 'printed')]
+        eq_([('stdout', 'printed')],
+            pickle.loads(pickle.dumps(failure)).captured)
+
+    def test_workers_capture_output(self):
+        loader = make_loader()
+        suite = loader.loadTestsFromModule(make_printing_sample_module())
+        plug = ConsoleDisplay(capture=True)
+        ipython_nose.run_in_processes(
+            loader, suite,
+            ['ipython-nose', '--no-skip', '--nocapture', '--nologcapture'],
+            plug, 2)
+        assert_in('line 999', dict(plug.failures[0].captured)['stdout'])
+
+
+def make_memory_sample_module():
+    def test_allocates():
+        block = bytearray(50 * 1024 * 1024)
+        for index in range(0, len(block), 4096):
+            block[index] = 1
+
+    def test_small():
+        pass
+
+    return build_sample_module(
+        test_allocates=test_allocates,
+        test_small=test_small)
+
+
+class TestMemoryProfiling(object):
+    def test_format_bytes(self):
+        eq_('512 bytes', ipython_nose.format_bytes(512))
+        eq_('1.5 KiB', ipython_nose.format_bytes(1536))
+        eq_('2.0 GiB', ipython_nose.format_bytes(2 * 1024 ** 3))
+
+    def test_off_by_default(self):
+        plug = ConsoleDisplay()
+        run_nose(plug, make_sample_module())()
+        eq_({}, plug.memory)
+        eq_(None, plug._memory)
+
+    def test_heaviest_test_is_found(self):
+        if ipython_nose.peak_rss() is None:
+            raise SkipTest('no way to measure memory here')
+        plug = ConsoleDisplay(profile_memory=True)
+        run_nose(plug, make_memory_sample_module())()
+        heaviest = plug.heaviest_tests()
+        eq_('test_module.test_allocates', heaviest[0][1])
+        assert heaviest[0][0] >= 40 * 1024 * 1024
+        assert_in('most memory (peak rise):', plug._repr_html_())
+
+    def test_allocation_sites(self):
+        if ipython_nose.tracemalloc is None:
+            raise SkipTest('needs tracemalloc')
+        plug = ConsoleDisplay(memory_sites=3)
+        plug.memory = {}
+        probe = plug._memory
+        probe.start()
+        kept = [bytearray(1024 * 1024)]
+        size, sites = probe.stop()
+        probe.close()
+        assert_in(__file__.rstrip('c'), sites[0][0])
+        assert sites[0][1] >= 1024 * 1024
+        eq_(False, ipython_nose.tracemalloc.is_tracing())
+
+    def test_heaviest_rendering(self):
+        plug = ipython_nose.IPythonDisplay(heaviest=1)
+        plug.num_tests = 2
+        plug.memory = {
+            'light': (1024, []),
+            'heavy': (3 * 1024 * 1024, [('cell.py:3', 2 * 1024 * 1024)]),
+            'unknown': (None, [])}
+        eq_([(3 * 1024 * 1024, 'heavy', [('cell.py:3', 2 * 1024 * 1024)])],
+            plug.heaviest_tests())
+        html = plug._repr_html_()
+        assert_in('3.0 MiB', html)
+        assert_in('<code>cell.py:3</code> +2.0 MiB', html)
+        assert_not_in('light', html)
+
+    def test_workers_report_memory(self):
+        loader = make_loader()
+        suite = loader.loadTestsFromModule(make_memory_sample_module())
+        plug = ConsoleDisplay(profile_memory=True)
+        ipython_nose.run_in_processes(
+            loader, suite, ['ipython-nose', '--no-skip'], plug, 2)
+        eq_(['test_module.test_allocates', 'test_module.test_small'],
+            sorted(plug.memory))
+
+
+def make_hanging_sample_module():
+    def test_hangs():
+        import time
+        time.sleep(30)
+
+    def test_spins():
+        while True:
+            pass
+
+    @ipython_nose.timeout(5)
+    def test_slow_but_allowed():
+        import time
+        time.sleep(0.3)
+
+    def test_after():
+        pass
+
+    return build_sample_module(
+        test_hangs=test_hangs,
+        test_spins=test_spins,
+        test_slow_but_allowed=test_slow_but_allowed,
+        test_after=test_after)
+
+
+class TestTimeouts(object):
+    def test_hanging_tests_are_interrupted(self):
+        plug = ConsoleDisplay(timeout=0.1)
+        run_nose(plug, make_hanging_sample_module())()
+        eq_({'test_module.test_hangs': 'error',
+             'test_module.test_spins': 'error',
+             'test_module.test_slow_but_allowed': 'pass',
+             'test_module.test_after': 'pass'}, plug.outcomes)
+        failure = plug.failures[0]
+        eq_('TimedOut', failure.exc_type)
+        assert failure.message.endswith(
+            'TimedOut: test took longer than 0.1 seconds')
+        # The stack shows where the test was when it was stopped
+        assert_in('time.sleep(30)', failure.formatted_traceback)
+
+    def test_no_timeout_by_default(self):
+        eq_(None, ipython_nose.timeout_for(FakeTest()))
+
+    def test_timeout_attribute_on_class(self):
+        test_module = make_class_sample_module()
+        test_module.TestGroup.timeout = 2
+        group = list(make_loader().loadTestsFromModule(test_module))[0]
+        eq_([2, 2], [ipython_nose.timeout_for(test, 10) for test in group])
+
+    def test_interrupts_background_thread(self):
+        plug = ConsoleDisplay(timeout=0.1)
+        test_module = make_hanging_sample_module()
+        del test_module.test_hangs
+        background = ipython_nose.BackgroundRun(
+            plug, run_nose(plug, test_module))
+        eq_(True, background.wait(10))
+        eq_('error', plug.outcomes['test_module.test_spins'])
+        eq_('pass', plug.outcomes['test_module.test_after'])
+
+    def in_thread(self, function):
+        raised = []
+
+        def run():
+            try:
+                function()
+            except ipython_nose.TimedOut as exception:
+                raised.append(exception)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join(10)
+        return raised
+
+    def test_timer_going_off_after_disarm_does_nothing(self):
+        watchdog = ipython_nose.Watchdog()
+
+        def test_ends_as_timer_goes_off():
+            watchdog.arm(10)
+            token = watchdog._armed
+            watchdog.disarm()
+            watchdog._interrupt(threading.current_thread().ident, token)
+            sum(range(10000))
+        eq_([], self.in_thread(test_ends_as_timer_goes_off))
+
+    def test_interruption_as_test_ends_does_not_escape(self):
+        watchdog = ipython_nose.Watchdog()
+        armed = threading.Event()
+        finished = threading.Event()
+        threads = []
+
+        def test_ends_while_interrupted():
+            watchdog.arm(10)
+            threads.append(threading.current_thread().ident)
+            armed.set()
+            finished.wait(10)
+            watchdog.disarm()
+            sum(range(10000))
+
+        def interrupt_as_disarming():
+            armed.wait(10)
+            with watchdog._lock:
+                finished.set()
+                # Let the test thread block on the lock in disarm()
+                time.sleep(0.1)
+                watchdog._armed = None
+                watchdog._interrupted = threads[0]
+                ipython_nose.ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ipython_nose._thread_id_type(threads[0]),
+                    ipython_nose.ctypes.py_object(ipython_nose.TimedOut))
+        interrupter = threading.Thread(target=interrupt_as_disarming)
+        interrupter.start()
+        eq_([], self.in_thread(test_ends_while_interrupted))
+        interrupter.join(10)
+
+    def test_timer_interrupts_while_armed(self):
+        watchdog = ipython_nose.Watchdog()
+
+        def test_spins():
+            watchdog.arm(0.05)
+            while True:
+                pass
+        eq_(1, len(self.in_thread(test_spins)))
+
+    def test_signal_handler_is_restored(self):
+        import signal
+        before = signal.getsignal(signal.SIGALRM)
+        watchdog = ipython_nose.Watchdog()
+        watchdog.arm(10)
+        watchdog.disarm()
+        eq_(before, signal.getsignal(signal.SIGALRM))
+        eq_((0.0, 0.0), signal.getitimer(signal.ITIMER_REAL))
+
+
+class TestProfiling(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.phases = ipython_nose.PhaseTimer()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def run(self, **kwargs):
+        plug = ipython_nose.IPythonDisplay(phases=self.phases, **kwargs)
+        plug.live_output = ipython_nose.ConsoleLiveOutput(
+            StreamOwner(ipython_nose.StringIO()))
+        with self.phases.phase('execution'):
+            run_nose(plug, make_sample_module())()
+        return plug
+
+    def test_phase_timer(self):
+        with self.phases.phase('config'):
+            pass
+        self.phases.add('config', 1.0)
+        self.phases.add('discovery', 2.0)
+        eq_(['config', 'discovery'], self.phases.names)
+        eq_(2, self.phases.phases['config'][1])
+        assert 1.0 <= self.phases.seconds('config') < 1.5
+        eq_(0.0, self.phases.seconds('rendering'))
+
+    def test_live_output_calls_are_timed(self):
+        stream = RecordingStream(tty=False)
+        live_output = ipython_nose.TimedLiveOutput(
+            ipython_nose.ConsoleLiveOutput(
+                StreamOwner(stream), flush_interval=0), self.phases)
+        live_output.write_chars('.')
+        live_output.finalize()
+        eq_(['live output: write_chars', 'live output: finalize'],
+            self.phases.names)
+        assert_in('.', ''.join(stream.writes))
+
+    def test_execution_is_split_into_tests_live_output_and_the_rest(self):
+        plug = self.run()
+        times = plug.phase_times()
+        eq_(('execution', None), times[0][::2])
+        names = [name for name, seconds, part_of in times[1:]]
+        eq_('tests', names[0])
+        assert_in('live output: write_chars', names)
+        eq_('fixtures, nose and plugin hooks', names[-1])
+        eq_(set(['execution']), set(part_of for _, _, part_of in times[1:]))
+        assert_in('time by phase:', plug._repr_html_())
+        assert_not_in('functions taking the most time', plug._repr_html_())
+
+    def test_live_output_is_not_counted_as_the_tests_time(self):
+        class SlowLiveOutput(object):
+            def write_chars(self, chars):
+                time.sleep(0.05)
+
+            def finalize(self):
+                pass
+
+        plug = ipython_nose.IPythonDisplay(phases=self.phases)
+        plug.live_output = SlowLiveOutput()
+        with self.phases.phase('execution'):
+            run_nose(plug, make_sample_module())()
+        assert self.phases.seconds('tests') < 0.05
+        times = dict(
+            (name, seconds) for name, seconds, _ in plug.phase_times())
+        assert times['live output: write_chars'] >= 0.2
+        # Not taken away from the execution time twice
+        assert times['fixtures, nose and plugin hooks'] < 0.05
+
+    def test_rendering_is_the_report_itself(self):
+        plug = self.run()
+        eq_(('rendering', 1.5, None), plug.phase_times(1.5)[-1])
+        assert 'rendering' not in self.phases.phases
+        html = plug._repr_html_()
+        assert html.index('expected failure') < html.index('time by phase:')
+        assert_in('rendering', html)
+
+    def test_off_by_default(self):
+        plug = ConsoleDisplay()
+        run_nose(plug, make_sample_module())()
+        eq_([], plug.phase_times())
+        eq_(None, plug.profile_stats)
+        assert_not_in('time by phase:', plug._repr_html_())
+
+    def test_tests_are_profiled_and_saved(self):
+        path = os.path.join(self.directory, 'tests.pstats')
+        plug = self.run(profile_tests=True, profile_output=path)
+        names = [name for _, _, _, name in plug.top_functions(count=1000)]
+        assert any('test_fails' in name for name in names)
+        assert_not_in('run_nose', ' '.join(names))
+        saved = ipython_nose.pstats.Stats(path)
+        eq_(set(plug.profile_stats.stats), set(saved.stats))
+        html = plug._repr_html_()
+        assert_in('functions taking the most time in tests', html)
+        assert_in(path, html)
+        eq_(plug.profiled_functions, len(plug.top_functions()))
+
+    def test_profile_options(self):
+        options, nose_args = ipython_nose.parse_magic_line(
+            '--profile --profile-tests --profile-output=run.pstats')
+        eq_({'profile': True, 'profile_tests': True,
+             'profile_output': 'run.pstats'}, options)
+
+
+class TestTimings(object):
+    def setup(self):
+        self.plugin = ipython_nose.IPythonDisplay(slowest=2)
+        self.plugin.num_tests = 3
+        self.plugin.timings = {'fast': 0.001, 'slow': 2.5, 'medium': 0.5}
+
+    def test_start_and_stop_test_record_timing(self):
+        plugin = ipython_nose.IPythonDisplay()
+        plugin.startTest(FakeTest())
+        plugin.stopTest(FakeTest())
+        eq_(['fake'], list(plugin.timings))
+        assert plugin.timings['fake'] >= 0
+
+    def test_start_and_stop_context_record_timing(self):
+        plugin = ipython_nose.IPythonDisplay()
+        plugin.startContext(types.ModuleType('test_module'))
+        plugin.startContext(FakeTest)
+        plugin.stopContext(FakeTest)
+        plugin.stopContext(types.ModuleType('test_module'))
+        eq_(['FakeTest', 'test_module'], sorted(plugin.context_timings))
+
+    def test_slowest_tests(self):
+        eq_([(2.5, 'slow'), (0.5, 'medium')], self.plugin.slowest_tests())
+
+    def test_html_lists_slowest_tests(self):
+        html = self.plugin._repr_html_()
+        assert_in('2.500s', html)
+        assert_in('medium', html)
+        assert_not_in('fast', html)
+
+    def test_pretty_lists_slowest_tests(self):
+        class MockPretty(object):
+            def __init__(self):
+                self.texts = []
+
+            def text(self, line):
+                self.texts.append(line)
+        p = MockPretty()
+        self.plugin._repr_pretty_(p=p, cycle=False)
+        assert_in('  2.500s slow\n', ''.join(p.texts))
+
+    def test_slowest_0_lists_none(self):
+        self.plugin.slowest = 0
+        assert_not_in('slowest tests:', self.plugin._repr_html_())
+
+
+class TestStreamingReports(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def open_report(self, filename):
+        return ipython_nose.open_report(
+            os.path.join(self.directory, filename))
+
+    def add_results(self, report):
+        report.add(FakeTest(), 'pass', 0.5)
+        report.add(FakeTest(), 'fail', 0.25, make_failure('<oops>'))
+        report.add(FakeTest(), 'skip', None)
+
+    def test_json_report_is_valid_after_each_result(self):
+        report = self.open_report('report.json')
+        eq_([], json.load(open(report.partial_path))['results'])
+        report.add(FakeTest(), 'pass', 0.5)
+        eq_(1, len(json.load(open(report.partial_path))['results']))
+
+    def test_json_report_contents(self):
+        report = self.open_report('report.json')
+        self.add_results(report)
+        report.close()
+        contents = json.load(open(report.path))
+        eq_(['pass', 'fail', 'skip'],
+            [result['outcome'] for result in contents['results']])
+        eq_('Exception: <oops>', contents['results'][1]['message'])
+        eq_(3, contents['summary']['tests'])
+        eq_(1, contents['summary']['failures'])
+        eq_(0.75, contents['summary']['time'])
+
+    def test_junit_report_is_valid_after_each_result(self):
+        report = self.open_report('report.xml')
+        eq_('0', ElementTree.parse(report.partial_path).getroot().get('tests'))
+        report.add(FakeTest(), 'pass', 0.5)
+        eq_('1', ElementTree.parse(report.partial_path).getroot().get('tests'))
+
+    def test_junit_report_contents(self):
+        report = self.open_report('report.xml')
+        self.add_results(report)
+        report.close()
+        suite = ElementTree.parse(report.path).getroot()
+        eq_('3', suite.get('tests'))
+        eq_('1', suite.get('failures'))
+        eq_('1', suite.get('skipped'))
+        testcases = suite.findall('testcase')
+        eq_(3, len(testcases))
+        failure = testcases[1].find('failure')
+        eq_('Exception: <oops>', failure.get('message'))
+        assert_in('<oops>', failure.text)
+        assert testcases[2].find('skipped') is not None
+
+    def test_report_replaces_its_path_when_closed(self):
+        path = os.path.join(self.directory, 'report.json')
+        with open(path, 'w') as old_report:
+            old_report.write('{"results": [], "summary": {"tests": 7}}')
+        report = self.open_report('report.json')
+        report.add(FakeTest(), 'pass', 0.5)
+        eq_(7, json.load(open(path))['summary']['tests'])
+        report.close()
+        report.close()
+        eq_(1, json.load(open(path))['summary']['tests'])
+        eq_(['report.json'], os.listdir(self.directory))
+
+    @raises(UsageError)
+    def test_unknown_report_format(self):
+        self.open_report('report.txt')
+
+    def test_rejected_line_leaves_no_report(self):
+        path = os.path.join(self.directory, 'report.json')
+        try:
+            run_magic(
+                '--report %s --processes 0' % path, make_sample_module())
+        except UsageError:
+            pass
+        else:
+            raise AssertionError('--processes 0 was accepted')
+        eq_([], os.listdir(self.directory))
+
+    def test_run_writes_the_report(self):
+        path = os.path.join(self.directory, 'report.xml')
+        run_magic('--report %s' % path, make_sample_module())
+        eq_(['report.xml'], os.listdir(self.directory))
+        eq_('4', ElementTree.parse(path).getroot().get('tests'))
+
+    def test_split_test_id(self):
+        eq_(('__main__.TestFoo', 'test_bar'),
+            ipython_nose._split_test_id('__main__.TestFoo.test_bar'))
+        eq_(('__main__', 'test_gen(1.5,)'),
+            ipython_nose._split_test_id('__main__.test_gen(1.5,)'))
+
+
+class CountingSelector(object):
+    """Wraps a real selector, remembering what it was asked about."""
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.match = selector.match
+        self.asked = []
+
+    def wantClass(self, cls):
+        self.asked.append(cls.__name__)
+        return self.selector.wantClass(cls)
+
+    def wantFunction(self, function):
+        self.asked.append(function.__name__)
+        return self.selector.wantFunction(function)
+
+
+class TestDiscoveryCache(object):
+    def setup(self):
+        self.cache = ipython_nose.DiscoveryCache()
+        self.selector = CountingSelector(make_loader().selector)
+        self.namespace = {'__name__': '__notebook__'}
+        run_cell(self.namespace, '\n'.join([
+            'import os',
+            'data = [1, 2, 3]',
+            'def helper(): pass',
+            'def test_one(): pass',
+            'class TestTwo(object): pass',
+            'def setup_module(): pass',
+        ]))
+
+    def test_module_has_only_tests_and_fixtures(self):
+        test_module = self.cache.test_module(self.namespace, self.selector)
+        eq_(['TestTwo', 'setup_module', 'test_one'],
+            sorted(name for name in vars(test_module)
+                   if not name.startswith('__')))
+
+    def test_only_new_and_rebound_names_are_checked_again(self):
+        self.cache.test_module(self.namespace, self.selector)
+        eq_(['TestTwo', 'helper', 'test_one'], sorted(self.selector.asked))
+        del self.selector.asked[:]
+        run_cell(self.namespace, 'def test_one(): pass\ndef test_3(): pass')
+        self.cache.test_module(self.namespace, self.selector)
+        eq_(['test_3', 'test_one'], sorted(self.selector.asked))
+
+    def test_module_is_named_after_namespace(self):
+        test_module = self.cache.test_module(self.namespace, self.selector)
+        eq_('__notebook__', test_module.__name__)
+
+    def test_removed_names_are_forgotten(self):
+        self.cache.test_module(self.namespace, self.selector)
+        del self.namespace['test_one']
+        test_module = self.cache.test_module(self.namespace, self.selector)
+        assert not hasattr(test_module, 'test_one')
+        assert 'test_one' not in self.cache.entries
+
+    def test_new_namespace_starts_again(self):
+        self.cache.test_module(self.namespace, self.selector)
+        del self.selector.asked[:]
+        self.cache.test_module(dict(self.namespace), self.selector)
+        eq_(['TestTwo', 'helper', 'test_one'], sorted(self.selector.asked))
+
+
+class TestNamespaceModule(object):
+    def setup(self):
+        self.namespace = {'__name__': '__notebook__', '_': 1}
+        run_cell(self.namespace, '\n'.join([
+            'data = [1, 2, 3]',
+            'def test_one(): pass',
+        ]))
+
+    def test_holds_only_given_names(self):
+        test_module = ipython_nose.namespace_module(
+            self.namespace, ['test_one'])
+        assert test_module.test_one is self.namespace['test_one']
+        assert not hasattr(test_module, 'data')
+
+    def test_skips_names_not_in_namespace(self):
+        test_module = ipython_nose.namespace_module(
+            self.namespace, ['test_one', 'test_gone'])
+        assert not hasattr(test_module, 'test_gone')
+
+    def test_is_named_after_namespace(self):
+        eq_('__notebook__',
+            ipython_nose.namespace_module(self.namespace, []).__name__)
+        eq_('test_module', ipython_nose.namespace_module({}, []).__name__)
+
+    def test_setting_attributes_leaves_namespace_alone(self):
+        test_module = ipython_nose.namespace_module(self.namespace, ['data'])
+        test_module.data = 'replaced'
+        eq_([1, 2, 3], self.namespace['data'])
+
+
+class TestNoseConfigCache(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.directory, 'setup.cfg')
+        self.write_config('[nosetests]\nverbosity=3\n[other]\nx=1\n')
+        self.original_all_config_files = ipython_nose.all_config_files
+        ipython_nose.all_config_files = lambda: [self.config_file]
+        self.cache = ipython_nose.NoseConfigCache()
+        self.searches = 0
+        original_find_plugins = self.cache._find_plugins
+
+        def find_plugins():
+            self.searches += 1
+            return original_find_plugins()
+        self.cache._find_plugins = find_plugins
+
+    def teardown(self):
+        ipython_nose.all_config_files = self.original_all_config_files
+        shutil.rmtree(self.directory)
+
+    def write_config(self, text, mtime=None):
+        with open(self.config_file, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.config_file, (mtime, mtime))
+
+    def configured(self, **kwargs):
+        config = self.cache.config({}, **kwargs)
+        # Configuring sets up nose's logging, at the config file's
+        # verbosity; kept out of the output of the run of these tests
+        config.logStream = ipython_nose.StringIO()
+        logger = logging.getLogger('nose')
+        level, handlers, propagate = (
+            logger.level, list(logger.handlers), logger.propagate)
+        logger.handlers[:] = []
+        try:
+            config.configure(['ipython-nose'])
+        finally:
+            logger.setLevel(level)
+            logger.handlers[:] = handlers
+            logger.propagate = propagate
+        return config
+
+    def test_config_files_are_used(self):
+        eq_(3, self.configured().verbosity)
+
+    def test_plugins_are_found_once(self):
+        self.configured()
+        config = self.configured()
+        eq_(1, self.searches)
+        assert config.plugins.plugins
+
+    def test_each_config_gets_fresh_plugins(self):
+        first = self.cache.config({})
+        second = self.cache.config({})
+        first.plugins.loadPlugins()
+        second.plugins.loadPlugins()
+        assert first.plugins.plugins[0] is not second.plugins.plugins[0]
+
+    def test_modified_config_file_is_read_again(self):
+        self.configured()
+        self.write_config('[nosetests]\nverbosity=4\n', mtime=1)
+        eq_(4, self.configured().verbosity)
+        eq_(2, self.searches)
+
+    def test_reload(self):
+        self.configured()
+        self.configured(reload=True)
+        eq_(2, self.searches)
+
+
+def run_nose(plug, test_module, *args):
+    loader = make_loader()
+    return lambda: nose_core.TestProgram(
+        argv=['ipython-nose', '--no-skip', '--with-ipython-html'] + list(args),
+        suite=loader.loadTestsFromModule(test_module),
+        addplugins=[plug], exit=False, config=loader.config)
+
+
+class TestBackgroundRun(object):
+    def test_runs_tests_in_background(self):
+        plug = ConsoleDisplay()
+        background = ipython_nose.BackgroundRun(
+            plug, run_nose(plug, make_sample_module()))
+        assert background.wait(10)
+        assert background.result is plug
+        eq_(4, plug.num_tests)
+        assert_in('2/4 tests passed', background._repr_html_())
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def test_blocks():
+            started.set()
+            release.wait(10)
+
+        def test_never_runs():
+            pass
+
+        test_module = types.ModuleType('test_module')
+        test_module.test_blocks = test_blocks
+        test_module.test_never_runs = test_never_runs
+        plug = ConsoleDisplay()
+        background = ipython_nose.BackgroundRun(
+            plug, run_nose(plug, test_module))
+        started.wait(10)
+        background.cancel()
+        assert_in('cancelling', background._repr_html_())
+        release.set()
+        assert background.wait(10)
+        eq_(1, plug.num_tests)
+
+    def test_error_in_run_is_shown(self):
+        def run():
+            raise ValueError('broken run')
+        background = ipython_nose.BackgroundRun(ConsoleDisplay(), run)
+        background.wait(10)
+        assert_in('broken run', background._repr_html_())
+
+    def test_exit_in_run_is_shown(self):
+        def run():
+            sys.exit(2)
+        background = ipython_nose.BackgroundRun(ConsoleDisplay(), run)
+        eq_(True, background.wait(10))
+        eq_(SystemExit, type(background.exception))
+        assert_in('Test run failed', background._repr_html_())
+        assert_in('SystemExit: 2', background._repr_html_())
+
+
+def make_class_sample_module():
+    class TestGroup(object):
+        def test_alpha(self):
+            pass
+
+        def test_beta(self):
+            pass
+
+    def test_gamma():
+        pass
+
+    # Named like the classes' module, as the kernel's namespace would be
+    return build_sample_module(
+        name=__name__,
+        TestGroup=TestGroup,
+        test_gamma=test_gamma)
+
+
+def loaded_names(test_module, **selection):
+    config = ipython_nose.makeNoseConfig({})
+    loader = nose_loader.TestLoader(
+        config=config,
+        selector=ipython_nose.SelectingSelector(config, **selection))
+    names = []
+
+    def collect(suite):
+        for test in suite:
+            if hasattr(test, '_tests'):
+                collect(test)
+            else:
+                names.append(test.id().split('.', 1)[1])
+    collect(loader.loadTestsFromModule(test_module))
+    return sorted(names)
+
+
+class TestSelectingSelector(object):
+    def test_no_selection(self):
+        eq_(['TestGroup.test_alpha', 'TestGroup.test_beta', 'test_gamma'],
+            loaded_names(make_class_sample_module()))
+
+    def test_select_glob(self):
+        eq_(['TestGroup.test_alpha'],
+            loaded_names(make_class_sample_module(), select=['*alpha']))
+
+    def test_select_class(self):
+        eq_(['TestGroup.test_alpha', 'TestGroup.test_beta'],
+            loaded_names(make_class_sample_module(), select=['TestGroup']))
+
+    def test_select_regex(self):
+        eq_(['TestGroup.test_beta', 'test_gamma'],
+            loaded_names(make_class_sample_module(), select=['re:(beta|gam)']))
+
+    def test_deselect(self):
+        eq_(['test_gamma'],
+            loaded_names(make_class_sample_module(), deselect=['TestGroup']))
+
+    def test_shards_split_all_tests(self):
+        names = []
+        for index in range(1, 4):
+            names.extend(
+                loaded_names(make_class_sample_module(), shard=(index, 3)))
+        eq_(loaded_names(make_class_sample_module()), sorted(names))
+
+    def test_shards_are_stable(self):
+        eq_(ipython_nose.in_shard('TestGroup.test_alpha', (1, 5)),
+            ipython_nose.in_shard('TestGroup.test_alpha', (1, 5)))
+
+    def test_parse_shard(self):
+        eq_((2, 3), ipython_nose.parse_shard('2/3'))
+
+    @raises(ValueError)
+    def test_parse_shard_out_of_range(self):
+        ipython_nose.parse_shard('4/3')
+
+    def test_repeated_select_options(self):
+        options, nose_args = ipython_nose.parse_magic_line(
+            '--select test_a --select=test_b --shard 1/2')
+        eq_(['test_a', 'test_b'], options['select'])
+        eq_((1, 2), options['shard'])
+
+    @raises(UsageError)
+    def test_negative_slowest(self):
+        ipython_nose.parse_magic_line('--slowest -1')
+
+    @raises(UsageError)
+    def test_negative_max_report_size(self):
+        ipython_nose.parse_magic_line('--max-report-size -5')
+
+    def test_memory_counts_cant_be_negative(self):
+        for line in ('--heaviest -1', '--memory-sites -1'):
+            try:
+                ipython_nose.parse_magic_line(line)
+            except UsageError:
+                pass
+            else:
+                raise AssertionError('%s was accepted' % line)
+
+    @raises(UsageError)
+    def test_negative_capture_limit(self):
+        ipython_nose.parse_magic_line('--capture-limit -1')
+
+    def test_timeout_must_be_positive(self):
+        eq_(0.5, ipython_nose.parse_magic_line('--timeout 0.5')[0]['timeout'])
+        for value in ('0', '-1', 'nan'):
+            try:
+                ipython_nose.parse_magic_line('--timeout ' + value)
+            except UsageError:
+                pass
+            else:
+                raise AssertionError('--timeout %s was accepted' % value)
+
+    @raises(UsageError)
+    def test_invalid_regex_is_a_usage_error(self):
+        ipython_nose.parse_magic_line("--deselect 're:slow|('")
+
+
+class TestIsVerbose(object):
+    def is_verbose(self, args, config=None):
+        return ipython_nose.is_verbose(ipython_nose.parse_nose_args(
+            config or make_loader().config, args))
+
+    def test_verbose_flags(self):
+        for args in (['-v'], ['-vv'], ['--verbose'], ['-x', '--verbosity=2'],
+                     ['-sv'], ['-vs'], ['--verbosity', '2']):
+            assert self.is_verbose(args), args
+
+    def test_not_verbose(self):
+        for args in ([], ['-x'], ['-s'], ['--verbosity=1'], ['--version'],
+                     ['--no-such-option']):
+            assert not self.is_verbose(args), args
+
+    def test_verbosity_in_config_file(self):
+        config = ipython_nose.makeNoseConfig({})
+        config.files = ipython_nose.StringIO('[nosetests]\nverbosity=2\n')
+        assert self.is_verbose([], config)
+
+
+class TestResultHistory(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.history = ipython_nose.ResultHistory(
+            os.path.join(self.directory, 'history.jsonl'))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_history(self):
+        eq_(set(), self.history.last_failed())
+
+    def test_default_path_is_per_notebook(self):
+        session = os.environ.pop('JPY_SESSION_NAME', None)
+        try:
+            eq_('.ipython_nose_history.jsonl', ipython_nose.history_path({}))
+            eq_('.ipython_nose_history.jsonl', ipython_nose.history_path(
+                {'__session__': 'not-a-notebook'}))
+            eq_(os.path.join(os.sep + 'work', '.a.ipython_nose_history.jsonl'),
+                ipython_nose.history_path(
+                    {'__session__': os.path.join(os.sep + 'work', 'a.ipynb')}))
+            eq_('.b.ipython_nose_history.jsonl', ipython_nose.history_path(
+                {'__vsc_ipynb_file__': os.path.join('work', 'b.ipynb')}))
+            os.environ['JPY_SESSION_NAME'] = 'c.ipynb'
+            eq_('.c.ipython_nose_history.jsonl', ipython_nose.history_path({}))
+        finally:
+            os.environ.pop('JPY_SESSION_NAME', None)
+            if session is not None:
+                os.environ['JPY_SESSION_NAME'] = session
+
+    def test_last_failed_comes_from_last_run(self):
+        self.history.record({'a': 'fail', 'b': 'pass'})
+        self.history.record({'a': 'pass', 'b': 'error', 'c': 'skip'})
+        eq_(set(['b']), self.history.last_failed())
+
+    def test_half_written_line_is_ignored(self):
+        self.history.record({'a': 'fail'})
+        with open(self.history.path, 'a') as f:
+            f.write('{"outcomes": {"a": ')
+        eq_(set(['a']), self.history.last_failed())
+
+    def test_lines_that_are_not_runs_are_ignored(self):
+        self.history.record({'a': 'fail'})
+        with open(self.history.path, 'a') as f:
+            f.write('[1, 2]\n\n{"time": 1}\n')
+        eq_(set(), self.history.last_failed())
+        eq_([], self.history.flaky_tests({'a': 'pass'}))
+        eq_(2, len(self.history.recent()))
+
+    def test_recent_reads_back_only_as_far_as_needed(self):
+        self.history.block_size = 16
+        self.history.window = 3
+        for number in range(30):
+            self.history.record({'test_%d' % number: 'fail'})
+        eq_([{'test_27': 'fail'}, {'test_28': 'fail'}, {'test_29': 'fail'}],
+            [run['outcomes'] for run in self.history.recent()])
+        eq_(set(['test_29']), self.history.last_failed())
+        eq_(30, len(list(self.history.runs())))
+
+    def test_flaky_tests_flip_twice(self):
+        self.history.record({'a': 'pass', 'b': 'pass', 'c': 'fail'})
+        self.history.record({'a': 'fail', 'b': 'pass', 'c': 'pass'})
+        self.history.record({'a': 'skip', 'b': 'error', 'c': 'pass'})
+        eq_(['a'], self.history.flaky_tests(
+            {'a': 'pass', 'b': 'error', 'c': 'pass'}))
+
+    def test_flaky_tests_only_looks_at_window(self):
+        self.history.window = 1
+        self.history.record({'a': 'fail'})
+        self.history.record({'a': 'pass'})
+        eq_([], self.history.flaky_tests({'a': 'fail'}))
+
+    def test_duration_regressions(self):
+        for seconds in (0.2, 0.1, 0.3):
+            self.history.record(
+                {'slow': 'pass', 'tiny': 'pass', 'new': 'pass'},
+                {'slow': seconds, 'tiny': seconds / 100})
+        eq_([(1.0, 0.2, 'slow')], self.history.duration_regressions(
+            {'slow': 1.0, 'tiny': 0.01, 'new': 5.0}))
+
+    def test_finalize_flags_and_records(self):
+        for outcome in ('pass', 'fail'):
+            self.history.record({'a': outcome}, {'a': 0.2})
+        self.history.record({'a': 'pass'}, {'a': 0.2})
+        plugin = ipython_nose.IPythonDisplay(history=self.history)
+        plugin.stream = ipython_nose.StringIO()
+        plugin.live_output = ipython_nose.ConsoleLiveOutput(
+            StreamOwner(ipython_nose.StringIO()))
+        plugin.num_tests = 1
+        plugin.outcomes = {'a': 'fail'}
+        plugin.timings = {'a': 1.5}
+        plugin.finalize(None)
+        eq_(['a'], plugin.flaky)
+        eq_([(1.5, 0.2, 'a')], plugin.regressions)
+        eq_({'a': 1.5}, list(self.history.runs())[-1]['timings'])
+        html = plugin._repr_html_()
+        assert_in('flaky tests:', html)
+        assert_in('usually 0.200s', html)
+
+
+class TestOrderFailedFirst(object):
+    def test_failed_tests_move_to_front(self):
+        loader = make_loader()
+        suite = loader.loadTestsFromModule(make_class_sample_module())
+        eq_(['TestGroup', 'test_gamma'], [
+            ipython_nose._suite_item_name(test, ['TestGroup', 'test_gamma'])
+            for test in loader.loadTestsFromModule(
+                make_class_sample_module())])
+        ordered = ipython_nose.order_failed_first(
+            loader, suite, [__name__ + '.test_gamma'])
+        eq_(__name__ + '.test_gamma', list(ordered)[0].id())
+
+
+def write_notebook(path, sources, nbformat=4):
+    cells = [{'cell_type': 'code', 'source': source, 'input': source,
+              'metadata': {}, 'outputs': []} for source in sources]
+    cells.insert(0, {'cell_type': 'markdown', 'source': '# Tests',
+                     'metadata': {}})
+    if nbformat >= 4:
+        notebook = {'nbformat': 4, 'nbformat_minor': 2, 'metadata': {},
+                    'cells': cells}
+    else:
+        notebook = {'nbformat': 3, 'nbformat_minor': 0, 'metadata': {},
+                    'worksheets': [{'cells': cells, 'metadata': {}}]}
+    with open(path, 'w') as notebook_file:
+        json.dump(notebook, notebook_file)
+
+
+class TestBatchRunner(object):
+    def setup(self):
+        if not hasattr(os, 'fork'):
+            raise SkipTest('needs os.fork')
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def notebook(self, name, sources, nbformat=4):
+        path = os.path.join(self.directory, name)
+        write_notebook(path, sources, nbformat)
+        return path
+
+    def test_code_cells(self):
+        for nbformat in (3, 4):
+            path = self.notebook('cells.ipynb', ['x = 1', ['y = 2\n', 'z']],
+                                 nbformat)
+            eq_(['x = 1', 'y = 2\nz'], ipython_nose.notebook_code_cells(path))
+
+    def test_find_notebooks(self):
+        os.mkdir(os.path.join(self.directory, '.ipynb_checkpoints'))
+        first = self.notebook('a.ipynb', [])
+        self.notebook('.ipynb_checkpoints/a-checkpoint.ipynb', [])
+        self.notebook('notes.txt', [])
+        eq_([first, 'other.ipynb'], list(ipython_nose.find_notebooks(
+            [self.directory, 'other.ipynb'])))
+
+    def test_cell_magic_runs_test_classes(self):
+        path = self.notebook('classes.ipynb', [
+            '%load_ext ipython_nose',
+            '%%nose\n'
+            'class TestGroup(object):\n'
+            '    def test_passes(self):\n'
+            '        pass\n'
+            '    def test_fails(self):\n'
+            '        assert False\n'])
+        result, = ipython_nose.run_notebooks([path])
+        eq_(None, result['error'])
+        run, = result['runs']
+        eq_((2, 1), (run['tests'], run['failed']))
+
+    def test_runs_notebooks_in_processes(self):
+        passing = self.notebook('passing.ipynb', [
+            '%load_ext ipython_nose', 'def test_ok(): pass', '%nose'])
+        failing = self.notebook('failing.ipynb', [
+            '%load_ext ipython_nose',
+            'def test_fails():\n    print("noisy")\n    assert False',
+            'result = %nose'])
+        raising = self.notebook('raising.ipynb', [
+            'print("before")', 'raise ValueError("boom")', 'x = 1'])
+        results = dict(
+            (result['path'], result) for result in ipython_nose.run_notebooks(
+                [passing, failing, raising], processes=2))
+        eq_(1, results[passing]['runs'][0]['tests'])
+        eq_(0, results[passing]['runs'][0]['failed'])
+        eq_(None, results[passing]['error'])
+        failure = results[failing]['runs'][0]['failures'][0]
+        eq_('AssertionError', failure['exc_type'])
+        eq_([['stdout', 'noisy\n']], failure['captured'])
+        eq_('code cell 2 raised ValueError: boom', results[raising]['error'])
+        assert_in('before', results[raising]['output'])
+        eq_({'notebooks': 3, 'passed': 1, 'failed': 1, 'errors': 1,
+             'tests': 2, 'failures': 1, 'skipped': 0},
+            ipython_nose.summarize_notebooks(list(results.values())))
+
+    def test_crashed_and_hanging_notebooks_are_errors(self):
+        crashing = self.notebook('crashing.ipynb', ['import os; os._exit(3)'])
+        hanging = self.notebook('hanging.ipynb', [
+            'import time; time.sleep(30)'])
+        results = dict(
+            (result['path'], result['error'])
+            for result in ipython_nose.run_notebooks(
+                [crashing, hanging], processes=2, timeout=1))
+        eq_({crashing: 'exited with code 3 before finishing',
+             hanging: 'took longer than 1 seconds'}, results)
+
+    def test_main_writes_json_and_exits_with_status(self):
+        passing = self.notebook('passing.ipynb', [
+            '%load_ext ipython_nose', 'def test_ok(): pass', '%nose'])
+        json_path = os.path.join(self.directory, 'results.json')
+        eq_(0, ipython_nose.main([passing, '--json', json_path]))
+        with open(json_path) as json_file:
+            results = json.load(json_file)
+        eq_(1, results['summary']['passed'])
+        eq_({'__main__.test_ok': 'pass'},
+            results['notebooks'][0]['runs'][0]['outcomes'])
+        self.notebook('failing.ipynb', [
+            '%load_ext ipython_nose', 'def test_no(): assert False', '%nose'])
+        eq_(1, ipython_nose.main([self.directory]))